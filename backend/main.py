@@ -166,6 +166,13 @@ def get_r2_client():
         print(f"Failed to create R2 client: {e}")
         return None
 
+# RunPod handler是生成器，/run和/runsync的output是全部产出的列表，最后一条是完整结果
+def runpod_final_output(result: Dict[str, Any]) -> Any:
+    output = result.get("output", {})
+    if isinstance(output, list):
+        output = output[-1] if output else {}
+    return output
+
 @app.get("/")
 async def root():
     return {"message": "AI Chat API is running", "endpoints": ["/chat", "/health", "/models"]}
@@ -244,7 +251,10 @@ async def chat(request: ChatRequest):
                     print(f"RunPod result: {result}")
                     
                     if result.get("status") == "COMPLETED":
-                        ai_response = result.get("output", {}).get("text", "").strip()
+                        output = runpod_final_output(result)
+                        if isinstance(output, dict):
+                            output = output.get("text") or output.get("response") or ""
+                        ai_response = str(output).strip()
                         
                         # 清理响应，移除提示词格式
                         if ai_response:
@@ -766,10 +776,11 @@ async def speech_to_text(request: STTRequest):
                         # 提取转录文本
                         transcription = ""
                         if "output" in result:
-                            if isinstance(result["output"], str):
-                                transcription = result["output"]
-                            elif isinstance(result["output"], dict):
-                                transcription = result["output"].get("text", result["output"].get("transcription", ""))
+                            output = runpod_final_output(result)
+                            if isinstance(output, str):
+                                transcription = output
+                            elif isinstance(output, dict):
+                                transcription = output.get("text", output.get("transcription", ""))
                         
                         if transcription:
                             print(f"✅ 语音转文字成功: {transcription}")
@@ -317,6 +317,11 @@ class ChatHistoryManager {
           if (response.ok) {
             const result = await response.json();
             
+            // handler是生成器，/runsync返回全部产出的列表，最后一条是完整结果
+            if (Array.isArray(result.output)) {
+              result.output = result.output[result.output.length - 1];
+            }
+            
             // 处理不同的RunPod响应格式
             let content = '';
             if (result.output) {
@@ -771,6 +776,10 @@ export default {
             const result = await runpodResponse.json();
             
             if (result.status === 'COMPLETED') {
+              // handler是生成器，/runsync返回全部产出的列表，最后一条是完整结果
+              if (Array.isArray(result.output)) {
+                result.output = result.output[result.output.length - 1];
+              }
               let transcription = '';
               if (typeof result.output === 'string') {
                 transcription = result.output;
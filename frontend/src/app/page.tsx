@@ -427,6 +427,11 @@ export default function ChatPage() {
                   console.log('🔍 output类型:', typeof data.output)
                   console.log('🔍 output内容:', data.output)
                   
+                  // handler是生成器，/runsync返回全部产出的列表，最后一条是完整结果
+                  if (Array.isArray(data.output)) {
+                    data.output = data.output[data.output.length - 1]
+                  }
+                  
                   // 直接处理output字段 - 简化逻辑
                   if (data.output !== null && data.output !== undefined) {
                     console.log('✅ 发现output字段，开始处理')
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+连续批处理调度器 - 与主上下文共享模型权重，另建多序列上下文，每一步把所有序列的token放进同一个batch解码
+"""
+
+import time
+import queue
+import logging
+import threading
+from typing import Optional, Dict, Any, Tuple, List
+
+import numpy as np
+import llama_cpp
+from llama_cpp import Llama
+
+from generation import GenerationJob, sample_token
+
+logger = logging.getLogger(__name__)
+
+class BatchScheduler:
+    """连续批处理调度器：多个序列共享同一份权重和KV缓存，每一步一起解码"""
+    
+    def __init__(self, llm: Llama, n_slots: int, n_ctx_per_slot: int):
+        self.llm = llm
+        self.n_slots = n_slots
+        self.n_ctx_per_slot = n_ctx_per_slot
+        self.n_batch = max(llm.n_batch, n_slots)
+        self.n_vocab = llm.n_vocab()
+        self.eos_token = llm.token_eos()
+        
+        # 与主上下文共享模型权重，另建一个支持多序列的上下文
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_slots * n_ctx_per_slot
+        params.n_batch = self.n_batch
+        params.n_seq_max = n_slots
+        params.n_threads = llm.context_params.n_threads
+        params.n_threads_batch = llm.context_params.n_threads_batch
+        # 沿用主上下文的KV缓存类型和flash attention，量化KV让同样显存放下更多序列
+        params.type_k = llm.context_params.type_k
+        params.type_v = llm.context_params.type_v
+        params.flash_attn = llm.context_params.flash_attn
+        self.ctx = llama_cpp.llama_new_context_with_model(llm.model, params)
+        if not self.ctx:
+            raise RuntimeError("批处理上下文创建失败")
+        self.batch = llama_cpp.llama_batch_init(self.n_batch, 0, n_slots)
+        
+        self.slots: List[Optional[GenerationJob]] = [None] * n_slots
+        self.steps = 0
+        self.tokens_decoded = 0
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._thread.start()
+        logger.info(f"🧵 批处理调度器已启动: {n_slots}个序列槽, 每槽上下文{n_ctx_per_slot}, n_batch={self.n_batch}")
+    
+    def submit(self, job: GenerationJob) -> GenerationJob:
+        self._queue.put(job)
+        return job
+    
+    def close(self) -> None:
+        self._stop.set()
+        self._queue.put(None)
+        self._thread.join()
+        llama_cpp.llama_batch_free(self.batch)
+        llama_cpp.llama_free(self.ctx)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "slots": self.n_slots,
+            "active": sum(job is not None for job in self.slots),
+            "queued": self._queue.qsize(),
+            "steps": self.steps,
+            "tokens_decoded": self.tokens_decoded,
+            "n_ctx": self.n_slots * self.n_ctx_per_slot,
+            # 批处理路径每个任务都从头计算提示词
+            "bypasses": ["prefix_cache", "snapshots", "speculation"],
+        }
+    
+    def _admit(self) -> None:
+        """在两步之间把排队的任务放入空闲槽"""
+        idle = not any(self.slots)
+        while None in self.slots:
+            try:
+                job = self._queue.get(timeout=0.1) if idle else self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if job is None:
+                return
+            idle = False
+            
+            reason = job.stop_reason()
+            if reason:
+                job.finish(reason)
+                continue
+            if len(job.prompt_tokens) >= self.n_ctx_per_slot:
+                job.finish("error", ValueError(f"提示词过长: {len(job.prompt_tokens)} >= {self.n_ctx_per_slot}"))
+                continue
+            
+            seq_id = self.slots.index(None)
+            job.seq_id = seq_id
+            job.started_at = time.time()
+            self.slots[seq_id] = job
+            llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq_id, -1, -1)
+    
+    def _release(self, job: GenerationJob, reason: str, error: Optional[Exception] = None) -> None:
+        self.slots[job.seq_id] = None
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, job.seq_id, -1, -1)
+        job.finish(reason, error)
+    
+    def _fill_batch(self) -> List[Tuple[GenerationJob, int]]:
+        """组装本步batch：先放解码中的序列（每个1个token），剩余容量分给预填充的提示词"""
+        n = 0
+        logit_rows = []
+        active = sorted((job for job in self.slots if job is not None), key=lambda job: len(job.pending))
+        for job in active:
+            take = min(len(job.pending), self.n_batch - n)
+            if take <= 0:
+                break
+            for i in range(take):
+                self.batch.token[n] = job.pending[i]
+                self.batch.pos[n] = job.n_past + i
+                self.batch.n_seq_id[n] = 1
+                self.batch.seq_id[n][0] = job.seq_id
+                is_last = i == len(job.pending) - 1
+                self.batch.logits[n] = is_last
+                if is_last:
+                    logit_rows.append((job, n))
+                n += 1
+            job.n_past += take
+            job.pending = job.pending[take:]
+        self.batch.n_tokens = n
+        return logit_rows
+    
+    def _step(self) -> None:
+        # 请求已取消或超时的序列立即释放槽位，不再占用解码
+        for job in [job for job in self.slots if job is not None]:
+            reason = job.stop_reason()
+            if reason:
+                self._release(job, reason)
+        
+        logit_rows = self._fill_batch()
+        if self.batch.n_tokens == 0:
+            return
+        
+        result = llama_cpp.llama_decode(self.ctx, self.batch)
+        self.steps += 1
+        self.tokens_decoded += self.batch.n_tokens
+        if result != 0:
+            error = RuntimeError(f"llama_decode失败: {result}")
+            for job in [job for job in self.slots if job is not None]:
+                self._release(job, "error", error)
+            return
+        
+        for job, row in logit_rows:
+            logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(self.ctx, row), shape=(self.n_vocab,)).copy()
+            recent = (job.prompt_tokens[-64:] + job.completion_tokens)[-64:]
+            token = sample_token(logits, job.temperature, job.top_k, job.top_p, job.repeat_penalty, recent, job.rng)
+            
+            if token == self.eos_token:
+                self._release(job, "stop")
+                continue
+            stopped = job.append_token(token, self.llm.detokenize([token], special=True))
+            if stopped:
+                self._release(job, stopped)
+            elif len(job.completion_tokens) >= job.max_tokens or job.n_past + 1 >= self.n_ctx_per_slot:
+                self._release(job, "length")
+            else:
+                job.pending = [token]
+    
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self._admit()
+                self._step()
+            except Exception as e:
+                logger.error(f"❌ 批处理调度异常: {e}")
+                for job in [job for job in self.slots if job is not None]:
+                    self._release(job, "error", e)
+        
+        for job in [job for job in self.slots if job is not None]:
+            self._release(job, "error", RuntimeError("调度器已关闭"))
@@ -0,0 +1,790 @@
+#!/usr/bin/env python3
+"""
+Handler性能基准 - 在CPU上用小型GGUF模型验证推理优化
+用法: python3 benchmark_handler.py batching --model /path/to/tiny.gguf
+      python3 benchmark_handler.py stt-burst --model tiny
+      python3 benchmark_handler.py speculative --model /path/to/tiny.gguf --draft /path/to/tinier.gguf
+      python3 benchmark_handler.py planner --budgets-gb 8 24 48
+      python3 benchmark_handler.py kv --model /path/to/tiny.gguf --configs f16 f16+fa q8_0+fa q4_0+fa
+      python3 benchmark_handler.py snapshot --model /path/to/tiny.gguf
+      python3 benchmark_handler.py cpu-pool --model /path/to/tiny.gguf --replicas 0 --jobs 16
+      python3 benchmark_handler.py replay --model /path/to/tiny.gguf --whisper tiny --output result.json --baseline baseline.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+def bench_batching(args):
+    """连续批处理：并发数增加时总吞吐(tokens/s)应随之提升"""
+    os.environ["BATCH_SLOTS"] = str(max(args.concurrency))
+    import handler_llama_ai as h
+    from caches import tokenize_text
+
+    resident = h.model_registry.get(args.model)
+    scheduler = h.get_batch_scheduler(resident)
+    prompt_tokens = tokenize_text(resident.llm, h.format_prompt(args.prompt))
+
+    results = []
+    for concurrency in args.concurrency:
+        start = time.time()
+        jobs = [
+            scheduler.submit(h.GenerationJob(prompt_tokens, max_tokens=args.max_tokens, temperature=0, stop=[]))
+            for _ in range(concurrency)
+        ]
+        for job in jobs:
+            job.wait()
+        elapsed = time.time() - start
+
+        tokens = sum(len(job.completion_tokens) for job in jobs)
+        results.append({
+            "concurrency": concurrency,
+            "completion_tokens": tokens,
+            "seconds": round(elapsed, 3),
+            "tokens_per_second": round(tokens / elapsed, 2),
+        })
+        print(f"📊 并发{concurrency}: {tokens} tokens, {elapsed:.2f}秒, {tokens / elapsed:.1f} tokens/s")
+
+    scheduler.close()
+    print(json.dumps(results, indent=2))
+
+    increasing = all(b["tokens_per_second"] > a["tokens_per_second"] for a, b in zip(results, results[1:]))
+    if increasing:
+        print("✅ 总吞吐随并发提升")
+        return 0
+    print("❌ 总吞吐没有随并发提升")
+    return 1
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def bench_stt_burst(args):
+    """STT微批处理：同一突发负载下比较不同批大小的吞吐和p95延迟"""
+    import random
+    from concurrent.futures import ThreadPoolExecutor
+
+    import numpy as np
+    import stt
+
+    if args.audio:
+        with open(args.audio, "rb") as f:
+            clip = stt.decode_audio(f.read())
+    else:
+        # 合成语音长度的带噪正弦波，只用于测量耗时
+        t = np.arange(int(args.clip_seconds * stt.WHISPER_SAMPLE_RATE)) / stt.WHISPER_SAMPLE_RATE
+        clip = (0.1 * np.sin(2 * np.pi * 220 * t) + 0.01 * np.random.randn(len(t))).astype(np.float32)
+
+    # 预热：加载模型，避免首个批次计入加载时间
+    stt.speech_batcher = stt.SpeechBatcher(1, 0)
+    stt.transcribe_clip(clip, args.model)
+
+    results = []
+    for batch_size in args.batch_sizes:
+        stt.speech_batcher = stt.SpeechBatcher(batch_size, args.max_wait_ms)
+        arrivals = sorted(random.uniform(0, args.burst_ms / 1000) for _ in range(args.clips))
+
+        def run_clip(arrival, start):
+            time.sleep(max(0.0, start + arrival - time.time()))
+            submitted = time.time()
+            stt.transcribe_clip(clip, args.model)
+            return time.time() - submitted
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=args.clips) as pool:
+            latencies = list(pool.map(lambda arrival: run_clip(arrival, start), arrivals))
+        elapsed = time.time() - start
+
+        results.append({
+            "batch_size": batch_size,
+            "clips": args.clips,
+            "seconds": round(elapsed, 3),
+            "clips_per_second": round(args.clips / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+            "batcher": stt.speech_batcher.stats(),
+        })
+        print(f"📊 批大小{batch_size}: {args.clips / elapsed:.2f} 条/秒, p95 {percentile(latencies, 0.95) * 1000:.0f}ms")
+
+    print(json.dumps(results, indent=2))
+    return 0
+
+SPECULATIVE_PROMPT = (
+    "Repeat the following paragraph exactly, then summarize it in one sentence.\n\n"
+    "The quick brown fox jumps over the lazy dog. The dog does not react, because it is lazy, "
+    "and the fox runs back into the forest where it lives with its family of foxes."
+)
+
+def bench_speculative(args):
+    """投机解码：贪心解码下各模式输出必须完全一致，比较解码吞吐与接受率"""
+    os.environ["SPECULATIVE_ENABLED"] = "1"
+    os.environ["SPECULATIVE_TARGETS"] = os.path.basename(args.model)
+    os.environ["BATCH_SLOTS"] = "1"
+    import handler_llama_ai as h
+    from caches import tokenize_text
+
+    resident = h.model_registry.get(args.model)
+    prompt_tokens = tokenize_text(resident.llm, h.format_prompt(args.prompt))
+
+    results = []
+    outputs = {}
+    for mode in args.modes:
+        runs = []
+        for _ in range(args.repeats):
+            job = h.GenerationJob(prompt_tokens, max_tokens=args.max_tokens, temperature=0, stop=[])
+            job.speculative = mode
+            job.draft_model_path = args.draft
+            for _ in h.generate_classic(job, resident):
+                pass
+            runs.append(job)
+
+        timings = [job.timing() for job in runs]
+        tokens_per_second = sorted(t.get("decode_tokens_per_second", 0.0) for t in timings)[len(timings) // 2]
+        speculation = runs[-1].speculation or {}
+        outputs[mode] = runs[-1].completion_tokens
+        results.append({
+            "mode": runs[-1].speculative,
+            "completion_tokens": len(runs[-1].completion_tokens),
+            "decode_tokens_per_second": tokens_per_second,
+            "acceptance_rate": speculation.get("acceptance_rate"),
+            "speculation": speculation,
+        })
+        print(f"📊 {mode}: {tokens_per_second:.1f} tokens/s, 接受率 {speculation.get('acceptance_rate', '-')}")
+
+    baseline = results[0]["decode_tokens_per_second"]
+    for result in results:
+        result["speedup"] = round(result["decode_tokens_per_second"] / baseline, 2) if baseline else None
+    print(json.dumps(results, indent=2))
+
+    reference = outputs[args.modes[0]]
+    mismatched = [mode for mode, tokens in outputs.items() if tokens != reference]
+    if mismatched:
+        print(f"❌ 输出与{args.modes[0]}模式不一致: {mismatched}")
+        return 1
+    print("✅ 各模式输出一致")
+    return 0
+
+def write_synthetic_gguf(f, n_layer=24, n_embd=2048, n_head=32, n_head_kv=8, n_ff=8192, n_vocab=32000,
+                         n_ctx_train=32768, tensor_type=12):
+    """写一个只有头部的合成GGUF（llama结构，默认Q4_K权重），用于在CPU上测试显存规划"""
+    import struct
+
+    def string(value):
+        data = value.encode()
+        return struct.pack("<Q", len(data)) + data
+
+    metadata = [
+        ("general.architecture", 8, string("llama")),
+        ("llama.block_count", 4, struct.pack("<I", n_layer)),
+        ("llama.embedding_length", 4, struct.pack("<I", n_embd)),
+        ("llama.attention.head_count", 4, struct.pack("<I", n_head)),
+        ("llama.attention.head_count_kv", 4, struct.pack("<I", n_head_kv)),
+        ("llama.context_length", 4, struct.pack("<I", n_ctx_train)),
+        # 超长字符串数组，模拟词表（规划时应被跳过）
+        ("tokenizer.ggml.tokens", 9, struct.pack("<IQ", 8, n_vocab) + b"".join(string(f"t{i}") for i in range(n_vocab))),
+    ]
+    head_dim = n_embd // n_head
+    tensors = [("token_embd.weight", [n_embd, n_vocab]), ("output.weight", [n_embd, n_vocab]), ("output_norm.weight", [n_embd])]
+    for i in range(n_layer):
+        tensors += [
+            (f"blk.{i}.attn_q.weight", [n_embd, n_embd]),
+            (f"blk.{i}.attn_k.weight", [n_embd, n_head_kv * head_dim]),
+            (f"blk.{i}.attn_v.weight", [n_embd, n_head_kv * head_dim]),
+            (f"blk.{i}.attn_output.weight", [n_embd, n_embd]),
+            (f"blk.{i}.ffn_gate.weight", [n_embd, n_ff]),
+            (f"blk.{i}.ffn_up.weight", [n_embd, n_ff]),
+            (f"blk.{i}.ffn_down.weight", [n_ff, n_embd]),
+        ]
+
+    f.write(b"GGUF" + struct.pack("<IQQ", 3, len(tensors), len(metadata)))
+    for key, value_type, value in metadata:
+        f.write(string(key) + struct.pack("<I", value_type) + value)
+    for name, dims in tensors:
+        ggml_type = 0 if len(dims) == 1 else tensor_type
+        f.write(string(name) + struct.pack("<I", len(dims)) + struct.pack(f"<{len(dims)}Q", *dims) + struct.pack("<IQ", ggml_type, 0))
+
+def bench_planner(args):
+    """显存规划：用合成或真实GGUF头在模拟预算下规划，检查结果放得下且随预算单调"""
+    import io
+
+    import memory_planner as planner
+
+    if args.model:
+        with open(args.model, "rb") as f:
+            header = planner.read_gguf_header(f)
+    else:
+        buffer = io.BytesIO()
+        write_synthetic_gguf(buffer, n_layer=args.layers, n_embd=args.embd, n_vocab=args.vocab)
+        buffer.seek(0)
+        start = time.time()
+        header = planner.read_gguf_header(buffer)
+        print(f"📖 解析合成GGUF头: {(time.time() - start) * 1000:.1f}ms")
+    geometry = planner.gguf_model_geometry(header)
+    weights_gb = (sum(geometry["layer_bytes"]) + geometry["input_bytes"] + geometry["output_bytes"]) / 1024**3
+    print(f"📐 {geometry['arch']}: {geometry['n_layer']}层, 权重{weights_gb:.2f}GB")
+
+    results = []
+    failures = []
+    previous = None
+    for budget_gb in sorted(args.budgets_gb):
+        gpu_budget = int(budget_gb * 1024**3)
+        host_budget = int(args.host_gb * 1024**3) if args.host_gb else None
+        plan = planner.plan_model_memory(geometry, gpu_budget, host_budget, args.kv_types, args.batch,
+                                         args.min_ctx, args.max_ctx, flash_attn=args.flash_attn)
+        rank = (plan["n_gpu_layers"] if plan["n_gpu_layers"] >= 0 else geometry["n_layer"] + 1, plan["n_ctx"])
+        if plan["fits"] and plan["gpu_bytes"] > gpu_budget:
+            failures.append(f"{budget_gb}GB: 规划结果超出预算")
+        if previous and plan["fits"] and previous[1]["fits"] and rank < previous[0]:
+            failures.append(f"{budget_gb}GB: 预算增加后配置反而变小")
+        previous = (rank, plan)
+        results.append({"gpu_budget_gb": budget_gb, **{k: plan[k] for k in ("n_gpu_layers", "n_ctx", "kv_type", "fits")},
+                        "gpu_gb": round(plan["gpu_bytes"] / 1024**3, 2), "cpu_gb": round(plan["cpu_bytes"] / 1024**3, 2)})
+        print(f"📊 预算{budget_gb}GB: n_gpu_layers={plan['n_gpu_layers']}, n_ctx={plan['n_ctx']}, "
+              f"KV={plan['kv_type']}, 显存{plan['gpu_bytes'] / 1024**3:.2f}GB")
+
+    print(json.dumps(results, indent=2))
+    for failure in failures:
+        print(f"❌ {failure}")
+    return 1 if failures else 0
+
+def bench_snapshot(args):
+    """对话状态快照：第一轮写盘后清空内存状态，第二轮必须从快照恢复，且贪心输出与完整计算一致"""
+    import tempfile
+
+    os.environ["SNAPSHOT_DIR"] = tempfile.mkdtemp(prefix="kv_snapshots-")
+    os.environ["SNAPSHOT_LOCAL_DIR"] = ""
+    os.environ["SNAPSHOT_IDLE_SECONDS"] = "0"   # 网络卷层平时等对话空闲才写，这里立即写
+    os.environ["PREFIX_CACHE_ENABLED"] = "0"   # 关闭内存前缀缓存，只能从磁盘快照复用
+    os.environ["RESPONSE_CACHE_ENABLED"] = "0"
+    os.environ["BATCH_SLOTS"] = "1"
+    import handler_llama_ai as h
+
+    resident = h.model_registry.get(args.model)
+    conversation_id = "benchmark-conversation"
+
+    def turn(prompt, history, conversation):
+        job, pieces = h.start_generation(resident, prompt, history=history, max_tokens=args.max_tokens,
+                                         temperature=0, semantic=False, conversation_id=conversation)
+        for _ in pieces:
+            pass
+        return job
+
+    first = turn(args.prompt, [], conversation_id)
+    deadline = time.time() + 60
+    while h.snapshot_store.flushes < 1 and time.time() < deadline:
+        time.sleep(0.05)
+    if h.snapshot_store.flushes < 1:
+        print(f"❌ 第一轮快照没有写盘: {h.snapshot_store.stats()}")
+        return 1
+    history = [{"role": "user", "content": args.prompt}, {"role": "assistant", "content": first.text}]
+
+    # 基线：不带对话ID，清空上下文后完整计算第二轮
+    resident.llm.reset()
+    cold = turn(args.followup, history, None)
+
+    # 模拟换了一个worker：清空上下文后带对话ID，应从快照恢复
+    resident.llm.reset()
+    restores = h.snapshot_store.restores
+    warm = turn(args.followup, history, conversation_id)
+
+    results = {
+        "prompt_tokens": len(warm.prompt_tokens),
+        "cold": {"reused_tokens": cold.reused_tokens, **cold.timing()},
+        "snapshot": {"reused_tokens": warm.reused_tokens, **warm.timing()},
+        "snapshots": h.snapshot_store.stats(),
+    }
+    print(json.dumps(results, indent=2))
+
+    failures = []
+    if h.snapshot_store.restores <= restores or warm.reused_tokens == 0:
+        failures.append("第二轮没有从快照恢复")
+    if warm.completion_tokens != cold.completion_tokens:
+        failures.append("从快照恢复后的贪心输出与完整计算不一致")
+    for failure in failures:
+        print(f"❌ {failure}")
+    if failures:
+        return 1
+    print(f"✅ 快照恢复{warm.reused_tokens}/{len(warm.prompt_tokens)} tokens，输出一致")
+    return 0
+
+def bench_cpu_pool(args):
+    """CPU副本池：打印本机的副本/NUMA/CPU分配；给出模型时并发提交任务，检查每个副本都分到任务并报告总吞吐"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    os.environ["WARMUP_ENABLED"] = "0"
+    import handler_llama_ai as h
+
+    plan = h.plan_cpu_replicas(args.replicas, args.threads)
+    for index, (node, cpus) in enumerate(plan):
+        print(f"🧵 副本{index}: NUMA节点{node}, {len(cpus)}核 {cpus}")
+    if not args.model:
+        print(json.dumps([{"numa_node": node, "cpus": cpus} for node, cpus in plan], indent=2))
+        return 0
+
+    pool = h.new_cpu_pool(args.model, plan)
+    start = time.time()
+    pool.start()
+    print(f"✅ {len(plan)}个副本就绪: {time.time() - start:.1f}秒")
+
+    def run(index):
+        job, pieces, _ = pool.submit({"prompt": f"{args.prompt} #{index}", "max_tokens": args.max_tokens,
+                                      "temperature": 0, "coalesce": False})
+        for _ in pieces:
+            pass
+        return job
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        jobs = list(executor.map(run, range(args.jobs)))
+    elapsed = time.time() - start
+    tokens = sum(len(job.completion_tokens) for job in jobs)
+    stats = pool.stats()
+    pool.close()
+
+    print(json.dumps(stats, indent=2))
+    print(f"📊 {args.jobs}个任务: {tokens} tokens, {elapsed:.2f}秒, 总吞吐{tokens / elapsed:.1f} tokens/s")
+    idle = [name for name, replica in stats["per_replica"].items() if replica["completed"] == 0]
+    if idle:
+        print(f"❌ 没有分到任务的副本: {idle}")
+        return 1
+    print("✅ 所有副本都分到了任务")
+    return 0
+
+KV_PROMPTS = [
+    "Explain how a hash map works, step by step.",
+    "写一段关于长城历史的介绍。",
+    "List five prime numbers and explain why each is prime.",
+]
+
+def bench_kv(args):
+    """KV缓存量化与flash attention：KV内存、提示词/解码吞吐、相对第一个配置的贪心输出漂移"""
+    import handler_llama_ai as h
+    import memory_planner as planner
+    from llama_cpp import Llama
+
+    with open(args.model, "rb") as f:
+        geometry = planner.gguf_model_geometry(planner.read_gguf_header(f))
+
+    results = []
+    baseline_outputs = None
+    for config in args.configs:
+        kv_type, _, option = config.partition("+")
+        flash_attn = option == "fa"
+        llm = Llama(model_path=args.model, n_ctx=args.ctx, n_batch=args.batch, n_gpu_layers=args.gpu_layers,
+                    type_k=planner.GGML_TYPE_IDS[kv_type], type_v=planner.GGML_TYPE_IDS[kv_type], flash_attn=flash_attn,
+                    verbose=False)
+        try:
+            estimate = planner.estimate_memory(geometry, args.ctx, args.gpu_layers, kv_type, args.batch, flash_attn)
+            text_tokens = llm.tokenize(b"The quick brown fox jumps over the lazy dog. ", add_bos=False)
+            prompt_tokens = (text_tokens * (args.prompt_tokens // len(text_tokens) + 1))[:args.prompt_tokens]
+            speed = {
+                "prompt_tokens_per_second": h.measure_prompt_throughput(llm, prompt_tokens),
+                "decode_tokens_per_second": h.measure_decode_throughput(llm, prompt_tokens, args.decode_tokens),
+            }
+
+            outputs = []
+            for prompt in KV_PROMPTS:
+                tokens = llm.tokenize(h.format_prompt(prompt).encode(), add_bos=False, special=True)
+                completion = []
+                for token in llm.generate(tokens, top_k=1, temp=0.0, repeat_penalty=1.0, reset=True):
+                    if token == llm.token_eos() or len(completion) >= args.max_tokens:
+                        break
+                    completion.append(token)
+                outputs.append(completion)
+        finally:
+            llm.close()
+
+        result = {
+            "config": config,
+            "kv_type": kv_type,
+            "flash_attn": flash_attn,
+            "kv_mb": round((estimate["gpu_kv"] + estimate["cpu_kv"]) / 1024**2, 1),
+            "scratch_mb": round(estimate["scratch"] / 1024**2, 1),
+            **speed,
+        }
+        if baseline_outputs is None:
+            baseline_outputs = outputs
+        else:
+            # 漂移：逐位置token一致的比例，以及首次分叉的位置
+            agreements, divergences = [], []
+            for base, current in zip(baseline_outputs, outputs):
+                length = max(len(base), len(current), 1)
+                agreements.append(sum(a == b for a, b in zip(base, current)) / length)
+                divergences.append(h.common_prefix_length(base, current))
+            result["token_agreement"] = round(sum(agreements) / len(agreements), 3)
+            result["first_divergence"] = divergences
+        results.append(result)
+        print(f"📊 {config}: KV {result['kv_mb']}MB, 提示词 {speed['prompt_tokens_per_second']} tokens/s, "
+              f"解码 {speed['decode_tokens_per_second']} tokens/s, 一致率 {result.get('token_agreement', 1.0)}")
+
+    print(json.dumps(results, indent=2))
+    return 0
+
+USER_PROMPTS = [
+    "你好",
+    "Tell me about yourself.",
+    "帮我写一首关于秋天的短诗",
+    "What is the capital of France and why is it famous?",
+    "Summarize the plot of a detective story in three sentences.",
+]
+
+def synthetic_wav(seconds, sample_rate=16000, seed=0):
+    """带噪正弦波WAV，只用于测量耗时"""
+    import io
+    import wave
+
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    samples = 0.1 * np.sin(2 * np.pi * 220 * t) + 0.01 * rng.standard_normal(len(t))
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes((samples * 32767).astype(np.int16).tobytes())
+    return buffer.getvalue()
+
+def synthetic_trace(args):
+    """合成任务轨迹：不同历史长度、人格、流式开关和STT语音按泊松到达"""
+    import random
+
+    import handler_llama_ai as h
+
+    # 只用handler里定义了系统提示词的人格，未定义的人格会退回default
+    personas = sorted(h.SYSTEM_PROMPTS)
+    rng = random.Random(args.seed)
+    trace = []
+    at = 0.0
+    for i in range(args.jobs):
+        at += rng.expovariate(args.rate) if args.rate > 0 else 0.0
+        if rng.random() < args.stt_ratio:
+            trace.append({
+                "at": round(at, 3),
+                "kind": "stt",
+                "audio_seconds": rng.choice([2.0, 5.0, 12.0]),
+                "input": {"format": "wav", "language": "en", "stream": rng.random() < 0.5},
+            })
+            continue
+        history = []
+        for turn in range(rng.choice([0, 2, 8, 24])):
+            history.append({"role": "user" if turn % 2 == 0 else "assistant", "content": rng.choice(USER_PROMPTS)})
+        trace.append({
+            "at": round(at, 3),
+            "kind": "text",
+            "input": {
+                "prompt": rng.choice(USER_PROMPTS),
+                "persona": rng.choice(personas),
+                "history": history,
+                "stream": rng.random() < args.stream_ratio,
+                "max_tokens": args.max_tokens,
+            },
+        })
+    return trace
+
+def load_trace(path):
+    """读取JSONL轨迹，每行 {"at": 秒, "kind": "text"|"stt", "input": {...}}"""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def prepare_input(entry, args):
+    """补齐STT音频（录音文件或合成音频）和模型路径"""
+    import base64
+
+    job_input = dict(entry["input"])
+    if entry.get("kind") == "stt":
+        if "audio_file" in entry:
+            with open(entry["audio_file"], "rb") as f:
+                audio = f.read()
+        else:
+            audio = synthetic_wav(entry.get("audio_seconds", 5.0))
+        job_input["audio_data"] = base64.b64encode(audio).decode()
+        job_input.setdefault("model_path", args.whisper)
+    return job_input
+
+async def replay_job(h, entry, job_input, start, semaphore):
+    """按轨迹时间提交一个任务，记录首条产出时间、总延迟和最终记录"""
+    import asyncio
+
+    await asyncio.sleep(max(0.0, start + entry["at"] - time.time()))
+    async with semaphore:
+        submitted = time.time()
+        first = None
+        final = None
+        async for record in h.handler({"id": f"replay-{entry['at']}", "input": job_input}):
+            if first is None:
+                first = time.time()
+            final = record
+        finished = time.time()
+
+    final = final or {}
+    result = {
+        "kind": entry.get("kind", "text"),
+        "stream": bool(job_input.get("stream")),
+        "latency_ms": (finished - submitted) * 1000,
+        "first_record_ms": ((first or finished) - submitted) * 1000,
+        "error": final.get("error"),
+    }
+    timing = final.get("timing", {})
+    if result["kind"] == "text":
+        result["ttft_ms"] = timing.get("time_to_first_token_ms", result["first_record_ms"])
+        result["decode_tokens_per_second"] = timing.get("decode_tokens_per_second")
+        result["completion_tokens"] = final.get("usage", {}).get("completion_tokens", 0)
+        result["persona"] = job_input.get("persona", "default")
+        result["history_turns"] = len(job_input.get("history", []))
+    else:
+        result["audio_seconds"] = timing.get("audio_seconds")
+        result["inference_ms"] = timing.get("inference_ms")
+    return result
+
+def summarize_latency(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return {}
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 0.50), 1),
+        "p99": round(percentile(values, 0.99), 1),
+        "max": round(max(values), 1),
+    }
+
+def summarize_replay(results, elapsed):
+    """按任务类型汇总：TTFT、tokens/s、p50/p99延迟、错误数"""
+    summary = {}
+    text = [r for r in results if r["kind"] == "text"]
+    if text:
+        tokens = sum(r["completion_tokens"] for r in text)
+        decode_rates = [r["decode_tokens_per_second"] for r in text if r["decode_tokens_per_second"]]
+        summary["text"] = {
+            "jobs": len(text),
+            "errors": sum(1 for r in text if r["error"]),
+            "latency_ms": summarize_latency([r["latency_ms"] for r in text]),
+            "ttft_ms": summarize_latency([r["ttft_ms"] for r in text]),
+            "stream_first_chunk_ms": summarize_latency([r["first_record_ms"] for r in text if r["stream"]]),
+            "decode_tokens_per_second": round(percentile(decode_rates, 0.50), 2) if decode_rates else None,
+            "throughput_tokens_per_second": round(tokens / elapsed, 2) if elapsed else None,
+        }
+    stt = [r for r in results if r["kind"] == "stt"]
+    if stt:
+        audio = sum(r["audio_seconds"] or 0 for r in stt)
+        summary["stt"] = {
+            "jobs": len(stt),
+            "errors": sum(1 for r in stt if r["error"]),
+            "latency_ms": summarize_latency([r["latency_ms"] for r in stt]),
+            "real_time_factor": round(elapsed / audio, 3) if audio else None,
+        }
+    return summary
+
+# 基准比较时各指标的方向：值越小越好 / 越大越好
+LOWER_IS_BETTER = [
+    ("cold_start_seconds",),
+    ("peak_rss_gb",),
+    ("summary", "text", "latency_ms", "p50"),
+    ("summary", "text", "latency_ms", "p99"),
+    ("summary", "text", "ttft_ms", "p50"),
+    ("summary", "text", "ttft_ms", "p99"),
+    ("summary", "stt", "latency_ms", "p50"),
+    ("summary", "stt", "latency_ms", "p99"),
+    ("summary", "stt", "real_time_factor"),
+]
+HIGHER_IS_BETTER = [
+    ("summary", "text", "decode_tokens_per_second"),
+    ("summary", "text", "throughput_tokens_per_second"),
+]
+
+def lookup_metric(report, path):
+    for key in path:
+        if not isinstance(report, dict) or key not in report:
+            return None
+        report = report[key]
+    return report
+
+def compare_with_baseline(report, baseline, tolerance):
+    """逐项与基线比较，超出容差的变差项视为回归"""
+    comparison = []
+    for path, lower_better in [(p, True) for p in LOWER_IS_BETTER] + [(p, False) for p in HIGHER_IS_BETTER]:
+        current, previous = lookup_metric(report, path), lookup_metric(baseline, path)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        regressed = change > tolerance if lower_better else change < -tolerance
+        comparison.append({
+            "metric": ".".join(path),
+            "baseline": previous,
+            "current": current,
+            "change": round(change, 3),
+            "regressed": regressed,
+        })
+    return comparison
+
+def bench_replay(args):
+    """轨迹回放：在进程内驱动handler()，输出可机读的JSON并可与基线比较"""
+    import asyncio
+    import platform
+    import resource
+
+    os.environ["DEFAULT_MODEL_PATH"] = args.model
+    os.environ["STT_PRELOAD_PATH"] = ""
+    os.environ.setdefault("MAX_CONCURRENCY", str(args.concurrency))
+
+    # 冷启动 = 导入handler + 加载并预热默认模型
+    cold_start = time.time()
+    import handler_llama_ai as h
+    h.model_ready.clear()
+    h.warm_up_models()
+    cold_start_seconds = time.time() - cold_start
+
+    trace = load_trace(args.trace) if args.trace else synthetic_trace(args)
+    if args.save_trace:
+        with open(args.save_trace, "w") as f:
+            for entry in trace:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    inputs = [prepare_input(entry, args) for entry in trace]
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(args.concurrency)
+        start = time.time()
+        results = await asyncio.gather(*[
+            replay_job(h, entry, job_input, start, semaphore) for entry, job_input in zip(trace, inputs)
+        ])
+        return results, time.time() - start
+
+    results, elapsed = asyncio.run(run_all())
+
+    import llama_cpp
+    report = {
+        "meta": {
+            "llama_cpp_python": getattr(llama_cpp, "__version__", "unknown"),
+            "python": platform.python_version(),
+            "cpu": h.cpu_model_name(),
+            "model": os.path.basename(args.model),
+            "whisper": args.whisper,
+            "jobs": len(trace),
+            "concurrency": args.concurrency,
+            "created_at": time.time(),
+        },
+        "cold_start_seconds": round(cold_start_seconds, 2),
+        "cold_start": h.cold_start,
+        "peak_rss_gb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2, 3),
+        "elapsed_seconds": round(elapsed, 2),
+        "summary": summarize_replay(results, elapsed),
+        "jobs": results,
+    }
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["baseline_comparison"] = compare_with_baseline(report, json.load(f), args.tolerance)
+        regressions = [c for c in report["baseline_comparison"] if c["regressed"]]
+        for c in regressions:
+            print(f"❌ 回归: {c['metric']} {c['baseline']} -> {c['current']} ({c['change']:+.1%})")
+        status = 1 if regressions else 0
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(json.dumps(report["summary"], indent=2, ensure_ascii=False))
+    if status == 0:
+        print("✅ 回放完成" + ("，未发现回归" if args.baseline else ""))
+    return status
+
+def main():
+    parser = argparse.ArgumentParser(description="RunPod handler性能基准")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    batching = subparsers.add_parser("batching", help="连续批处理吞吐随并发的变化")
+    batching.add_argument("--model", required=True, help="小型GGUF模型路径")
+    batching.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4])
+    batching.add_argument("--max-tokens", type=int, default=64)
+    batching.add_argument("--prompt", default="Write a short story about a robot.")
+    batching.set_defaults(func=bench_batching)
+
+    stt_burst = subparsers.add_parser("stt-burst", help="STT微批处理在突发负载下的吞吐与延迟")
+    stt_burst.add_argument("--model", default="tiny", help="本地Whisper检查点路径，或WHISPER_DOWNLOAD_ROOT下的模型名称")
+    stt_burst.add_argument("--audio", help="测试音频文件，默认使用合成音频")
+    stt_burst.add_argument("--clip-seconds", type=float, default=5.0)
+    stt_burst.add_argument("--clips", type=int, default=16)
+    stt_burst.add_argument("--burst-ms", type=float, default=200.0, help="所有语音在该时间窗口内随机到达")
+    stt_burst.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    stt_burst.add_argument("--max-wait-ms", type=float, default=50.0)
+    stt_burst.set_defaults(func=bench_stt_burst)
+
+    speculative = subparsers.add_parser("speculative", help="投机解码的输出一致性、加速比与接受率")
+    speculative.add_argument("--model", required=True, help="小型GGUF目标模型路径")
+    speculative.add_argument("--draft", help="起草GGUF模型路径（词表需与目标模型一致）")
+    speculative.add_argument("--modes", nargs="+", default=["off", "prompt", "draft"], choices=["off", "prompt", "draft"])
+    speculative.add_argument("--max-tokens", type=int, default=128)
+    speculative.add_argument("--repeats", type=int, default=3)
+    speculative.add_argument("--prompt", default=SPECULATIVE_PROMPT)
+    speculative.set_defaults(func=bench_speculative)
+
+    planner = subparsers.add_parser("planner", help="在模拟显存预算下检查GGUF显存规划")
+    planner.add_argument("--model", help="真实GGUF路径（只读取头部），默认使用合成头")
+    planner.add_argument("--layers", type=int, default=24)
+    planner.add_argument("--embd", type=int, default=2048)
+    planner.add_argument("--vocab", type=int, default=32000)
+    planner.add_argument("--budgets-gb", type=float, nargs="+", default=[0.5, 1, 2, 4, 8, 24, 48])
+    planner.add_argument("--host-gb", type=float, help="模拟主机内存预算，默认不限制")
+    planner.add_argument("--kv-types", nargs="+", default=["f16"])
+    planner.add_argument("--batch", type=int, default=512)
+    planner.add_argument("--min-ctx", type=int, default=4096)
+    planner.add_argument("--max-ctx", type=int, default=32768)
+    planner.add_argument("--flash-attn", action="store_true")
+    planner.set_defaults(func=bench_planner)
+
+    kv = subparsers.add_parser("kv", help="KV缓存类型与flash attention的内存、吞吐和输出漂移")
+    kv.add_argument("--model", required=True, help="小型GGUF模型路径")
+    kv.add_argument("--configs", nargs="+", default=["f16", "f16+fa", "q8_0+fa", "q4_0+fa"],
+                    help="KV类型，加+fa表示开启flash attention；第一个作为漂移基线")
+    kv.add_argument("--ctx", type=int, default=4096)
+    kv.add_argument("--batch", type=int, default=512)
+    kv.add_argument("--gpu-layers", type=int, default=0)
+    kv.add_argument("--prompt-tokens", type=int, default=1024)
+    kv.add_argument("--decode-tokens", type=int, default=64)
+    kv.add_argument("--max-tokens", type=int, default=64)
+    kv.set_defaults(func=bench_kv)
+
+    snapshot = subparsers.add_parser("snapshot", help="对话状态快照的写盘、恢复命中与输出一致性")
+    snapshot.add_argument("--model", required=True, help="小型GGUF模型路径")
+    snapshot.add_argument("--prompt", default="Tell me about the history of the Great Wall.")
+    snapshot.add_argument("--followup", default="Summarize that in one sentence.")
+    snapshot.add_argument("--max-tokens", type=int, default=64)
+    snapshot.set_defaults(func=bench_snapshot)
+
+    cpu_pool = subparsers.add_parser("cpu-pool", help="CPU多副本进程池的NUMA分配、路由与总吞吐")
+    cpu_pool.add_argument("--model", help="小型GGUF模型路径，不给出时只打印副本分配")
+    cpu_pool.add_argument("--replicas", type=int, default=0, help="副本数，0表示按每副本核数自动计算")
+    cpu_pool.add_argument("--threads", type=int, default=8, help="自动计算时每个副本的物理核数")
+    cpu_pool.add_argument("--jobs", type=int, default=16)
+    cpu_pool.add_argument("--max-tokens", type=int, default=64)
+    cpu_pool.add_argument("--prompt", default="Write a short story about a robot.")
+    cpu_pool.set_defaults(func=bench_cpu_pool)
+
+    replay = subparsers.add_parser("replay", help="回放任务轨迹，输出TTFT/吞吐/延迟分位数/峰值内存/冷启动并与基线比较")
+    replay.add_argument("--model", required=True, help="小型GGUF模型路径")
+    replay.add_argument("--whisper", default="tiny", help="STT模型路径或名称")
+    replay.add_argument("--trace", help="JSONL轨迹文件，默认生成合成轨迹")
+    replay.add_argument("--save-trace", help="把使用的轨迹保存为JSONL，便于之后复现")
+    replay.add_argument("--jobs", type=int, default=32, help="合成轨迹的任务数")
+    replay.add_argument("--rate", type=float, default=2.0, help="合成轨迹每秒到达的任务数，0表示同时到达")
+    replay.add_argument("--stream-ratio", type=float, default=0.5)
+    replay.add_argument("--stt-ratio", type=float, default=0.2)
+    replay.add_argument("--max-tokens", type=int, default=64)
+    replay.add_argument("--concurrency", type=int, default=4)
+    replay.add_argument("--seed", type=int, default=0)
+    replay.add_argument("--output", help="完整结果JSON输出路径")
+    replay.add_argument("--baseline", help="之前保存的结果JSON，用于比较")
+    replay.add_argument("--tolerance", type=float, default=0.1, help="允许的相对变差比例")
+    replay.set_defaults(func=bench_replay)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
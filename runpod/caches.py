@@ -0,0 +1,756 @@
+#!/usr/bin/env python3
+"""
+缓存 - 前缀KV状态、确定性响应、语义响应、消息段分词，以及跨worker的对话状态快照
+容量与开关由handler按配置传入；llama_cpp只在加载embedding模型和恢复快照时导入
+"""
+
+import os
+import json
+import time
+import shutil
+import struct
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple, List, Union, TYPE_CHECKING
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None   # 对话快照改用zlib压缩
+
+if TYPE_CHECKING:
+    from llama_cpp import Llama
+    from generation import GenerationJob
+    from handler_llama_ai import ResidentModel
+
+logger = logging.getLogger(__name__)
+
+def common_prefix_length(a, b) -> int:
+    """计算两个token序列的公共前缀长度（二分查找，切片比较在C层完成）"""
+    a, b = tuple(a), tuple(b)
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+def prefix_block_digests(tokens, block: int) -> List[bytes]:
+    """token序列在每个块边界处的前缀摘要，第i个对应tokens[:(i+1)*block]"""
+    array = np.asarray(tokens, dtype=np.int32)
+    digest = hashlib.blake2b(digest_size=16)
+    digests = []
+    for end in range(block, len(array) + 1, block):
+        digest.update(array[end - block:end].tobytes())
+        digests.append(digest.copy().digest())
+    return digests
+
+class PrefixStateCache:
+    """按token前缀缓存llama.cpp状态，字节预算LRU淘汰
+    
+    每个条目按块边界登记前缀摘要，查找时从最长的块前缀往短找，
+    只对共享最长块前缀的少数条目逐token比较，不扫描全部条目。
+    """
+    
+    def __init__(self, max_bytes: int, min_tokens: int, block: int = 16):
+        self.max_bytes = max_bytes
+        self.min_tokens = min_tokens   # 公共前缀短于此值时视为未命中
+        self.block = max(1, block)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # (模型路径, token元组) -> (状态, 字节数)
+        self._index: Dict[Tuple[str, bytes], set] = {}  # (模型路径, 块前缀摘要) -> 条目键集合
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _state_bytes(state) -> int:
+        """估算LlamaState占用的内存"""
+        size = getattr(state, "llama_state_size", 0)
+        for attr in ("scores", "input_ids"):
+            array = getattr(state, attr, None)
+            if array is not None and hasattr(array, "nbytes"):
+                size += array.nbytes
+        return int(size)
+    
+    def _unindex(self, key) -> None:
+        model_key, tokens = key
+        for digest in prefix_block_digests(tokens, self.block):
+            keys = self._index.get((model_key, digest))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[(model_key, digest)]
+    
+    def _remove(self, key) -> int:
+        self._unindex(key)
+        size = self._entries.pop(key)[1]
+        self.total_bytes -= size
+        return size
+    
+    def lookup(self, model_key: str, tokens: List[int]):
+        """查找与tokens公共前缀最长的缓存状态，返回(公共前缀长度, 状态)"""
+        digests = prefix_block_digests(tokens, self.block)
+        with self._lock:
+            best_key = None
+            best_len = 0
+            for digest in reversed(digests):
+                candidates = self._index.get((model_key, digest))
+                if not candidates:
+                    continue
+                # 更短的块前缀上的条目不可能比这里的更长
+                for key in candidates:
+                    common = common_prefix_length(key[1], tokens)
+                    if common > best_len:
+                        best_key, best_len = key, common
+                break
+            
+            if best_key is None or best_len < self.min_tokens:
+                self.misses += 1
+                return 0, None
+            
+            self.hits += 1
+            self._entries.move_to_end(best_key)
+            return best_len, self._entries[best_key][0]
+    
+    def store(self, model_key: str, tokens: List[int], state) -> None:
+        """保存状态，超出字节预算时淘汰最久未使用的条目"""
+        size = self._state_bytes(state)
+        if size > self.max_bytes:
+            logger.warning(f"⚠️ 前缀状态过大({size / 1024**2:.0f}MB)，跳过缓存")
+            return
+        
+        key = (model_key, tuple(tokens))
+        digests = prefix_block_digests(tokens, self.block)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (state, size)
+            self.total_bytes += size
+            for digest in digests:
+                self._index.setdefault((model_key, digest), set()).add(key)
+            
+            while self.total_bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+    
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+            self.total_bytes = 0
+    
+    def drop_model(self, model_key: str) -> None:
+        """模型被淘汰后丢弃它的全部状态"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == model_key]:
+                self._remove(key)
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+class ResponseCache:
+    """确定性生成的完整响应缓存：内存字节预算LRU + 可选磁盘层，条目超过TTL即失效"""
+    
+    def __init__(self, max_bytes: int, ttl: float, directory: str = ""):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self.total_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # 键 -> (条目, 字节数)
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(model_fingerprint: str, persona: str, prompt_tokens: List[int], sampling: Dict[str, Any]) -> str:
+        """模型指纹 + 人格 + 格式化后的提示词token + 采样参数"""
+        payload = json.dumps([model_fingerprint, persona, list(prompt_tokens), sampling], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+    
+    @staticmethod
+    def _entry_bytes(entry: Dict[str, Any]) -> int:
+        return len(entry["text"].encode()) + 4 * len(entry["completion_tokens"]) + 256
+    
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+    
+    def _expired(self, entry: Dict[str, Any]) -> bool:
+        return time.time() - entry["created_at"] > self.ttl
+    
+    def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        """查找未过期的响应，磁盘层命中时提升到内存"""
+        with self._lock:
+            item = self._entries.get(key)
+            if item and self._expired(item[0]):
+                self.total_bytes -= self._entries.pop(key)[1]
+                item = None
+            if item:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return item[0]
+        
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+        self._insert(key, entry)
+        return entry
+    
+    def store(self, key: str, job: "GenerationJob") -> None:
+        entry = {
+            "text": job.text,
+            "finish_reason": job.finish_reason,
+            "completion_tokens": list(job.completion_tokens),
+            "created_at": time.time(),
+        }
+        self._insert(key, entry)
+        self._write_disk(key, entry)
+    
+    def _insert(self, key: str, entry: Dict[str, Any]) -> None:
+        size = self._entry_bytes(entry)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (entry, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and self._entries:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+    
+    def _read_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        if not self.directory:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self._expired(entry):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry
+    
+    def _write_disk(self, key: str, entry: Dict[str, Any]) -> None:
+        if not self.directory:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logger.warning(f"⚠️ 响应缓存写入磁盘失败: {e}")
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+class SemanticPartition:
+    """一个(模型, 人格)分区：归一化向量矩阵 + 对应的响应，满了淘汰最久未命中的条目"""
+    
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.vectors = None            # (条目数, 维度)
+        self.entries: List[Dict[str, Any]] = []
+        self.last_used: List[float] = []
+    
+    def search(self, vector: "np.ndarray") -> Tuple[int, float]:
+        if self.vectors is None or not self.entries:
+            return -1, 0.0
+        scores = self.vectors @ vector
+        index = int(np.argmax(scores))
+        return index, float(scores[index])
+    
+    def remove(self, index: int) -> None:
+        self.vectors = np.delete(self.vectors, index, axis=0)
+        del self.entries[index]
+        del self.last_used[index]
+    
+    def add(self, vector: "np.ndarray", entry: Dict[str, Any]) -> bool:
+        """添加条目，容量已满时先淘汰一个并返回True"""
+        evicted = False
+        if len(self.entries) >= self.capacity:
+            self.remove(int(np.argmin(self.last_used)))
+            evicted = True
+        row = vector[np.newaxis, :]
+        self.vectors = row if self.vectors is None else np.vstack([self.vectors, row])
+        self.entries.append(entry)
+        self.last_used.append(time.time())
+        return evicted
+
+class SemanticCache:
+    """无历史提示词的语义响应缓存：embedding后在分区内做余弦相似度最近邻查找"""
+    
+    def __init__(self, threshold: float, capacity: int, ttl: float, model_path: str = "",
+                 enabled: bool = True, n_threads: Optional[int] = None):
+        self.threshold = threshold
+        self.capacity = capacity
+        self.ttl = ttl
+        self.model_path = model_path
+        self._enabled = enabled
+        self.n_threads = n_threads
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.embed_ms_total = 0.0
+        self.embeds = 0
+        self._partitions: Dict[Tuple[str, ...], SemanticPartition] = {}
+        self._embedder_model = None
+        self._lock = threading.Lock()
+        self._embed_lock = threading.Lock()
+        if enabled and not model_path:
+            logger.warning("⚠️ SEMANTIC_CACHE_ENABLED=1但未配置SEMANTIC_CACHE_MODEL，语义缓存不启用")
+    
+    @property
+    def enabled(self) -> bool:
+        return self._enabled and bool(self.model_path)
+    
+    def _embedder(self) -> "Llama":
+        """专用embedding模型，首次使用时加载；池化方式沿用模型GGUF里的设置（CLS或平均）"""
+        if self._embedder_model is None:
+            from llama_cpp import Llama
+            
+            logger.info(f"📂 加载embedding模型: {self.model_path}")
+            self._embedder_model = Llama(
+                model_path=self.model_path,
+                embedding=True,
+                n_ctx=512,
+                n_gpu_layers=-1,
+                n_threads=self.n_threads,
+                verbose=False,
+            )
+        return self._embedder_model
+    
+    def embed(self, text: str) -> "np.ndarray":
+        start = time.time()
+        with self._embed_lock:
+            vector = np.asarray(self._embedder().embed(text.strip()), dtype=np.float32)
+        if vector.ndim == 2:
+            vector = vector.mean(axis=0)
+        vector /= max(float(np.linalg.norm(vector)), 1e-8)
+        self.embed_ms_total += (time.time() - start) * 1000
+        self.embeds += 1
+        return vector
+    
+    def lookup(self, partition_key: Tuple[str, ...], vector: "np.ndarray") -> Tuple[Optional[Dict[str, Any]], float]:
+        """返回(相似度超过阈值且未过期的响应, 相似度)"""
+        with self._lock:
+            partition = self._partitions.get(partition_key)
+            if partition is None:
+                self.misses += 1
+                return None, 0.0
+            index, score = partition.search(vector)
+            if index >= 0 and time.time() - partition.entries[index]["created_at"] > self.ttl:
+                partition.remove(index)
+                index, score = partition.search(vector)
+            if index < 0 or score < self.threshold:
+                self.misses += 1
+                return None, score
+            self.hits += 1
+            partition.last_used[index] = time.time()
+            return partition.entries[index], score
+    
+    def store(self, partition_key: Tuple[str, ...], vector: "np.ndarray", job: "GenerationJob") -> None:
+        entry = {
+            "text": job.text,
+            "finish_reason": job.finish_reason,
+            "completion_tokens": list(job.completion_tokens),
+            "created_at": time.time(),
+        }
+        with self._lock:
+            partition = self._partitions.setdefault(partition_key, SemanticPartition(self.capacity))
+            if partition.add(vector, entry):
+                self.evictions += 1
+    
+    def drop_model(self, model_key: str) -> None:
+        """文本模型被淘汰时丢弃它的分区"""
+        with self._lock:
+            for key in [key for key in self._partitions if key[0] == model_key]:
+                del self._partitions[key]
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "partitions": len(self._partitions),
+                "entries": sum(len(partition.entries) for partition in self._partitions.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "avg_embed_ms": round(self.embed_ms_total / self.embeds, 1) if self.embeds else 0.0,
+            }
+
+class SegmentTokenCache:
+    """按(模型, 消息段文本)缓存分词结果，LRU淘汰；系统提示词和历史消息每轮只需分词一次"""
+    
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._tokens = OrderedDict()   # (模型路径, 消息段) -> token元组
+        self._lock = threading.Lock()
+    
+    def tokenize(self, llm: "Llama", model_key: str, segment: str) -> Tuple[int, ...]:
+        key = (model_key, segment)
+        with self._lock:
+            tokens = self._tokens.get(key)
+            if tokens is not None:
+                self.hits += 1
+                self._tokens.move_to_end(key)
+                return tokens
+            self.misses += 1
+        
+        tokens = tuple(tokenize_text(llm, segment))
+        with self._lock:
+            self._tokens[key] = tokens
+            if len(self._tokens) > self.capacity:
+                self._tokens.popitem(last=False)
+        return tokens
+    
+    def drop_model(self, model_key: str) -> None:
+        with self._lock:
+            for key in [key for key in self._tokens if key[0] == model_key]:
+                del self._tokens[key]
+    
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._tokens),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+def tokenize_text(llm: "Llama", text: str) -> List[int]:
+    """将已包含特殊标记的文本转为token，不再额外添加BOS"""
+    return llm.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+
+class ConversationSnapshotStore:
+    """对话状态快照：每个对话ID一个文件，后台线程压缩写盘，按TTL和目录总量回收
+    
+    文件格式: 魔数 | 头部长度(uint32) | JSON头部 | token序列(int32，未压缩) | 压缩后的llama.cpp状态
+    token序列不压缩，恢复前只读头部和token就能判断前缀是否匹配；sha256覆盖token与状态原文。
+    本地层每轮写入；共享层（网络卷）等对话空闲idle_seconds秒或模型被淘汰时才写，期间的新一轮会顺延。
+    """
+    
+    MAGIC = b"LLSNAP01"
+    
+    def __init__(self, local_directory: str, shared_directory: str, max_bytes: int, total_bytes: int,
+                 ttl: float, gc_interval: float, idle_seconds: float, min_tokens: int, enabled: bool = True):
+        self._enabled = enabled
+        self.min_tokens = min_tokens   # 与前缀缓存相同：公共前缀太短不值得恢复
+        self.local_directory = local_directory
+        self.shared_directory = shared_directory
+        self.directories = [d for d in (local_directory, shared_directory) if d]
+        self.max_bytes = max_bytes
+        self.total_bytes = total_bytes
+        self.ttl = ttl
+        self.gc_interval = gc_interval
+        self.idle_seconds = idle_seconds
+        self.saves = 0
+        self.saved_bytes = 0
+        self.flushes = 0
+        self.restores = 0
+        self.restore_ms_total = 0.0
+        self.misses = 0
+        self.checksum_failures = 0
+        self.gc_removed = 0
+        self._last_gc = 0.0
+        self._pending: Dict[str, tuple] = {}   # 文件名 -> 最新待写快照，同一对话只写最后一轮
+        self._idle: Dict[str, tuple] = {}      # 文件名 -> (写共享层的时间, 模型路径, 本地文件路径或文件内容)
+        self._cond = threading.Condition()
+        self._thread = None
+    
+    @property
+    def enabled(self) -> bool:
+        return self._enabled and bool(self.directories)
+    
+    @staticmethod
+    def _context_key(llm: "Llama") -> Dict[str, int]:
+        """状态只能恢复到相同上下文长度和KV类型的上下文"""
+        params = llm.context_params
+        return {"n_ctx": llm.n_ctx(), "type_k": int(params.type_k), "type_v": int(params.type_v)}
+    
+    @staticmethod
+    def _filename(resident: "ResidentModel", conversation_id: str) -> str:
+        digest = hashlib.sha256(str(conversation_id).encode()).hexdigest()[:32]
+        return f"{digest}-{resident.fingerprint[:12]}.snap"
+    
+    def save(self, resident: "ResidentModel", conversation_id: str, tokens: List[int], state) -> None:
+        """登记待写快照（调用方持有resident.lock），压缩和写盘在后台线程完成"""
+        if not self.enabled:
+            return
+        if state.llama_state_size > self.max_bytes:
+            logger.warning(f"⚠️ 对话状态过大({state.llama_state_size / 1024**2:.0f}MB)，跳过快照")
+            return
+        header = {
+            "model": resident.fingerprint,
+            **self._context_key(resident.llm),
+            "n_tokens": len(tokens),
+            "state_size": state.llama_state_size,
+            "seed": state.seed,
+            "created_at": time.time(),
+        }
+        with self._cond:
+            self._pending[self._filename(resident, conversation_id)] = (resident.path, header, tokens, state.llama_state)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="snapshot-writer", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+    
+    def flush(self, model_path: Optional[str] = None) -> None:
+        """让空闲等待中的快照立即写入共享层（模型被淘汰时调用，不传模型路径表示全部）"""
+        with self._cond:
+            for filename, (_, path, source) in list(self._idle.items()):
+                if model_path is None or path == model_path:
+                    self._idle[filename] = (0.0, path, source)
+            self._cond.notify()
+    
+    def _next_idle_flush(self) -> Optional[float]:
+        """距离最早一个共享层写入还有多少秒，没有时返回None（调用方持有锁）"""
+        if not self._idle:
+            return None
+        return max(0.0, min(flush_at for flush_at, _, _ in self._idle.values()) - time.time())
+    
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and self._next_idle_flush() != 0.0:
+                    self._cond.wait(self._next_idle_flush())
+                if self._pending:
+                    filename = next(iter(self._pending))
+                    task = (self._write, filename, *self._pending.pop(filename))
+                else:
+                    filename = min(self._idle, key=lambda name: self._idle[name][0])
+                    task = (self._flush_shared, filename, self._idle.pop(filename)[2])
+            try:
+                task[0](*task[1:])
+                if time.time() - self._last_gc > self.gc_interval:
+                    self.collect_garbage()
+            except Exception as e:
+                logger.warning(f"⚠️ 对话快照写入失败: {e}")
+    
+    @staticmethod
+    def _write_file(directory: str, filename: str, source: Union[bytes, str]) -> None:
+        """写到同目录下唯一的临时文件再原子替换，source为文件内容或要复制的本地文件路径"""
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=filename + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if isinstance(source, bytes):
+                    f.write(source)
+                else:
+                    with open(source, "rb") as src:
+                        shutil.copyfileobj(src, f, 16 * 1024**2)
+            os.replace(tmp_path, os.path.join(directory, filename))
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+    
+    def _flush_shared(self, filename: str, source: Union[bytes, str]) -> None:
+        try:
+            self._write_file(self.shared_directory, filename, source)
+        except FileNotFoundError:
+            # 本地层文件已被回收，这一轮的快照不再写共享层
+            if isinstance(source, bytes):
+                raise
+            return
+        self.flushes += 1
+        logger.info(f"💾 对话快照已写入共享层: {filename}")
+    
+    def _write(self, filename: str, model_path: str, header: Dict[str, Any], tokens: List[int], llama_state: bytes) -> None:
+        token_bytes = np.asarray(tokens, dtype=np.int32).tobytes()
+        digest = hashlib.sha256(token_bytes)
+        digest.update(llama_state)
+        if zstandard:
+            payload = zstandard.ZstdCompressor(level=3, threads=-1).compress(llama_state)
+            header["compression"] = "zstd"
+        else:
+            import zlib
+            payload = zlib.compress(llama_state, 1)
+            header["compression"] = "zlib"
+        header["sha256"] = digest.hexdigest()
+        header_bytes = json.dumps(header).encode()
+        blob = self.MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes + token_bytes + payload
+        
+        if self.local_directory:
+            self._write_file(self.local_directory, filename, blob)
+        if self.shared_directory:
+            # 没有本地层时只能把文件内容留在内存里等空闲；同一对话的新一轮会替换并顺延
+            source = os.path.join(self.local_directory, filename) if self.local_directory else blob
+            with self._cond:
+                self._idle[filename] = (time.time() + self.idle_seconds, model_path, source)
+                self._cond.notify()
+        self.saves += 1
+        self.saved_bytes += len(payload)
+        logger.info(f"💾 对话快照已保存: {filename}, {header['n_tokens']} tokens, "
+                    f"{len(llama_state) / 1024**2:.1f}MB -> {len(payload) / 1024**2:.1f}MB")
+    
+    def restore(self, resident: "ResidentModel", conversation_id: str, prompt_tokens: List[int], reused: int) -> int:
+        """前缀匹配且比当前可复用部分更长时恢复快照（调用方持有resident.lock），返回可复用的token数"""
+        if not self.enabled:
+            return reused
+        start = time.time()
+        filename = self._filename(resident, conversation_id)
+        for directory in self.directories:
+            path = os.path.join(directory, filename)
+            try:
+                result = self._restore_file(resident, path, prompt_tokens, reused)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"⚠️ 对话快照读取失败({path}): {e}")
+                continue
+            if result is not None:
+                self.restores += 1
+                self.restore_ms_total += (time.time() - start) * 1000
+                logger.info(f"📂 已恢复对话快照: {result} tokens, {(time.time() - start) * 1000:.0f}ms")
+                return result
+        self.misses += 1
+        return reused
+    
+    def _restore_file(self, resident: "ResidentModel", path: str, prompt_tokens: List[int], reused: int) -> Optional[int]:
+        if not os.path.exists(path):
+            return None
+        llm = resident.llm
+        with open(path, "rb") as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError("快照文件格式不正确")
+            header = json.loads(f.read(struct.unpack("<I", f.read(4))[0]))
+            if time.time() - header["created_at"] > self.ttl:
+                return None
+            if header["model"] != resident.fingerprint or any(header[k] != v for k, v in self._context_key(llm).items()):
+                return None
+            
+            token_bytes = f.read(header["n_tokens"] * 4)
+            tokens = np.frombuffer(token_bytes, dtype=np.int32).tolist()
+            common = common_prefix_length(tokens, prompt_tokens)
+            if common <= reused or common < self.min_tokens:
+                return None
+            payload = f.read()
+        
+        if header["compression"] == "zstd":
+            if zstandard is None:
+                raise ValueError("快照使用zstd压缩，但zstandard未安装")
+            llama_state = zstandard.ZstdDecompressor().decompress(payload, max_output_size=header["state_size"])
+        else:
+            import zlib
+            llama_state = zlib.decompress(payload)
+        digest = hashlib.sha256(token_bytes)
+        digest.update(llama_state)
+        if digest.hexdigest() != header["sha256"]:
+            self.checksum_failures += 1
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            raise ValueError("快照校验和不一致，已删除")
+        
+        import llama_cpp
+        
+        input_ids = np.zeros(llm.n_ctx(), dtype=np.intc)
+        input_ids[:len(tokens)] = tokens
+        # load_state把scores写入前n_tokens行，形状要与save_state保存的一致（最多n_batch行，logits_all时n_ctx行）；
+        # 快照不保存logits，恢复后至少重新计算一个token，这些行不会被采样用到
+        llm.load_state(llama_cpp.LlamaState(
+            input_ids=input_ids,
+            scores=llm.scores[:min(len(tokens), llm.scores.shape[0])],
+            n_tokens=len(tokens),
+            llama_state=llama_state,
+            llama_state_size=header["state_size"],
+            seed=header["seed"],
+        ))
+        return common
+    
+    def collect_garbage(self) -> None:
+        """删除过期快照，目录总量超出上限时从最旧的开始删"""
+        self._last_gc = time.time()
+        for directory in self.directories:
+            if not os.path.isdir(directory):
+                continue
+            files = []
+            # 网络卷上多个worker会同时回收，文件随时可能已被别人删掉
+            for entry in os.scandir(directory):
+                if not entry.name.endswith(".snap"):
+                    continue
+                try:
+                    stat = entry.stat()
+                    if time.time() - stat.st_mtime > self.ttl:
+                        os.remove(entry.path)
+                        self.gc_removed += 1
+                        continue
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.total_bytes:
+                    break
+                total -= size
+                try:
+                    os.remove(path)
+                    self.gc_removed += 1
+                except FileNotFoundError:
+                    pass
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "directories": self.directories,
+            "saves": self.saves,
+            "saved_bytes": self.saved_bytes,
+            "pending": len(self._pending),
+            "shared_flushes": self.flushes,
+            "awaiting_idle": len(self._idle),
+            "restores": self.restores,
+            "misses": self.misses,
+            "avg_restore_ms": round(self.restore_ms_total / self.restores, 1) if self.restores else 0.0,
+            "checksum_failures": self.checksum_failures,
+            "gc_removed": self.gc_removed,
+        }
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Whisper模型离线转换脚本 - 把Hugging Face格式的Whisper模型转换为CTranslate2 int8格式
+转换需要transformers/torch且耗时数分钟，在挂载了网络卷的Pod上运行一次，worker启动时直接加载转换结果
+用法: python3 convert_stt_model.py /runpod-volume/voice/whisper-large-v3-turbo [--quantization int8]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+def converted_dir(model_path: str, quantization: str = "int8") -> str:
+    """转换结果保存在模型目录旁边，handler按同样的规则查找"""
+    return f"{model_path.rstrip('/')}-ct2-{quantization}"
+
+def convert(model_path: str, quantization: str = "int8", force: bool = False) -> str:
+    import ctranslate2
+
+    if not os.path.exists(os.path.join(model_path, "config.json")):
+        raise FileNotFoundError(f"不是Hugging Face格式的Whisper模型: {model_path}")
+    output = converted_dir(model_path, quantization)
+    if os.path.exists(os.path.join(output, "model.bin")) and not force:
+        print(f"✅ 已存在转换结果: {output}")
+        return output
+
+    print(f"🔧 转换Whisper模型为CTranslate2 {quantization}格式: {model_path} -> {output}")
+    start = time.time()
+    ctranslate2.converters.TransformersConverter(
+        model_path,
+        copy_files=["tokenizer.json", "preprocessor_config.json"],
+    ).convert(output, quantization=quantization, force=True)
+    print(f"✅ 转换完成，耗时{time.time() - start:.0f}秒")
+    return output
+
+def main():
+    parser = argparse.ArgumentParser(description="把Hugging Face格式的Whisper模型离线转换为CTranslate2格式")
+    parser.add_argument("model_path", help="Hugging Face格式的Whisper模型目录")
+    parser.add_argument("--quantization", default="int8", help="CTranslate2量化类型")
+    parser.add_argument("--force", action="store_true", help="已有转换结果时也重新转换")
+    args = parser.parse_args()
+    try:
+        convert(args.model_path, args.quantization, args.force)
+    except Exception as e:
+        print(f"❌ 转换失败: {e}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
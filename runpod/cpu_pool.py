@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+CPU多副本进程池 - 按NUMA拓扑切分物理核，每个副本进程独立加载同一个GGUF，路由进程把任务交给最空闲的副本
+副本进程的入口由handler传入（它需要handler里的模型注册表和生成流程）
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+from pathlib import Path
+from typing import Optional, Dict, Any, Tuple, List, Callable, TYPE_CHECKING
+
+from generation import GenerationJob, LatencyHistograms
+
+if TYPE_CHECKING:
+    from handler_llama_ai import RequestCoalescer
+
+logger = logging.getLogger(__name__)
+
+def parse_cpu_list(text: str) -> List[int]:
+    """解析sysfs的CPU列表格式，例如 "0-3,8-11" """
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+def physical_cpus(cpus: List[int]) -> List[int]:
+    """每个物理核只保留第一个超线程，llama.cpp的矩阵计算在超线程上没有收益"""
+    kept, seen = [], set()
+    for cpu in cpus:
+        try:
+            with open(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list") as f:
+                core = tuple(parse_cpu_list(f.read()))
+        except OSError:
+            core = (cpu,)
+        if core not in seen:
+            seen.add(core)
+            kept.append(cpu)
+    return kept
+
+def numa_cpu_sets() -> List[List[int]]:
+    """每个NUMA节点上本进程可用的物理核，读不到拓扑时视为单节点"""
+    allowed = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else set(range(os.cpu_count() or 1))
+    nodes = []
+    for node_dir in sorted(Path("/sys/devices/system/node").glob("node[0-9]*"), key=lambda d: int(d.name[4:])):
+        try:
+            cpus = [cpu for cpu in parse_cpu_list((node_dir / "cpulist").read_text()) if cpu in allowed]
+        except (OSError, ValueError):
+            continue
+        if cpus:
+            nodes.append(physical_cpus(cpus))
+    return nodes or [physical_cpus(sorted(allowed))]
+
+def plan_cpu_replicas(replicas: int, threads_per_replica: int,
+                      nodes: Optional[List[List[int]]] = None) -> List[Tuple[int, List[int]]]:
+    """把副本分配到NUMA节点并切分节点内的物理核，返回[(节点, CPU列表)]
+    
+    replicas为0时每个节点按threads_per_replica个核一个副本；否则按节点轮流分配，
+    副本的线程不跨节点。
+    """
+    nodes = nodes or numa_cpu_sets()
+    if replicas <= 0:
+        counts = [max(1, len(cpus) // max(1, threads_per_replica)) for cpus in nodes]
+    else:
+        counts = [replicas // len(nodes) + (1 if node < replicas % len(nodes) else 0) for node in range(len(nodes))]
+    
+    plan = []
+    for node, (cpus, count) in enumerate(zip(nodes, counts)):
+        count = min(count, len(cpus))
+        for i in range(count):
+            plan.append((node, cpus[i * len(cpus) // count:(i + 1) * len(cpus) // count]))
+    return plan
+
+class ReplicaJob(GenerationJob):
+    """路由进程中代表副本上一条生成的任务，文本、token与耗时由副本进程回传"""
+    
+    def __init__(self, job_id: int):
+        super().__init__([], stop=[])
+        self.job_id = job_id
+        self.replica = None
+        self.remote_timing = None
+        self.remote_submitted_at = None
+    
+    def timing(self) -> Dict[str, float]:
+        if self.remote_timing is None:
+            timing = super().timing()
+        else:
+            # 副本的耗时从它开始处理算起，加上在路由和副本队列中等待的时间
+            timing = dict(self.remote_timing)
+            waited_ms = round(max(0.0, self.remote_submitted_at - self.submitted_at) * 1000, 1)
+            for key in ("queue_ms", "time_to_first_token_ms", "total_ms"):
+                if key in timing:
+                    timing[key] = round(timing[key] + waited_ms, 1)
+        timing["replica"] = self.replica
+        return timing
+
+class CpuReplica:
+    """CPU池中的一个副本进程及其进行中的任务"""
+    
+    def __init__(self, index: int, node: int, cpus: List[int]):
+        self.index = index
+        self.node = node
+        self.cpus = cpus
+        self.memory_share = 1.0   # 启动时分到的剩余内存比例，重启时沿用
+        self.process = None
+        self.conn = None
+        self.ready = threading.Event()
+        self.info: Dict[str, Any] = {}
+        self.jobs: Dict[int, ReplicaJob] = {}
+        self.completed = 0
+        self.tokens = 0
+        self.busy_seconds = 0.0
+        self.restarts = 0
+        self.started_at = time.time()
+        self._busy_since = None
+        self._send_lock = threading.Lock()
+    
+    def send(self, message) -> None:
+        with self._send_lock:
+            self.conn.send(message)
+    
+    def mark_busy(self) -> None:
+        """调用方持有池锁"""
+        if self._busy_since is None:
+            self._busy_since = time.time()
+    
+    def mark_idle_if_done(self) -> None:
+        """调用方持有池锁"""
+        if not self.jobs and self._busy_since is not None:
+            self.busy_seconds += time.time() - self._busy_since
+            self._busy_since = None
+    
+    def stats(self) -> Dict[str, Any]:
+        busy = self.busy_seconds + (time.time() - self._busy_since if self._busy_since else 0.0)
+        uptime = time.time() - self.started_at
+        return {
+            "pid": self.process.pid if self.process else None,
+            "numa_node": self.node,
+            "cpus": self.cpus,
+            "ready": self.ready.is_set(),
+            "inflight": len(self.jobs),
+            "completed": self.completed,
+            "completion_tokens": self.tokens,
+            "utilization": round(busy / uptime, 3) if uptime > 0 else 0.0,
+            "tokens_per_busy_second": round(self.tokens / busy, 2) if busy > 0 else 0.0,
+            "restarts": self.restarts,
+            **self.info,
+        }
+
+class CpuReplicaPool:
+    """CPU多副本进程池：每个副本独立加载同一个GGUF（mmap共享页缓存中的权重），
+    CPU亲和性限定在一个NUMA节点内的一组物理核；路由把每个任务交给进行中任务最少的就绪副本"""
+    
+    def __init__(self, model_path: str, plan: List[Tuple[int, List[int]]], replica_main: Callable,
+                 readiness_timeout: float, coalescer: Optional["RequestCoalescer"] = None,
+                 histograms: Optional[LatencyHistograms] = None):
+        """replica_main是副本进程入口，spawn按模块路径导入它；coalescer为None时不合并重复请求"""
+        self.model_path = model_path
+        self.replica_main = replica_main
+        self.readiness_timeout = readiness_timeout
+        self.coalescer = coalescer
+        self.histograms = histograms
+        self.name = os.path.basename(model_path)
+        self.replicas = [CpuReplica(index, node, cpus) for index, (node, cpus) in enumerate(plan)]
+        self.started_at = time.time()
+        self.routed = 0
+        self._next_job_id = 0
+        self._closing = False
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._mp = multiprocessing.get_context("spawn")   # 副本内会再创建llama.cpp线程，不能fork
+    
+    def start(self) -> Dict[str, Dict[str, Any]]:
+        """依次启动副本并等待就绪；依次加载让每个副本按剩余内存规划上下文，权重页缓存也只需读一遍"""
+        logger.info(f"🧵 启动CPU副本池: {self.name}, {len(self.replicas)}个副本, "
+                    f"CPU分配: {[(replica.node, len(replica.cpus)) for replica in self.replicas]}")
+        for position, replica in enumerate(self.replicas):
+            replica.memory_share = 1.0 / (len(self.replicas) - position)
+            self._spawn(replica)
+            with self._cond:
+                loaded = self._cond.wait_for(lambda: replica.ready.is_set() or "error" in replica.info, self.readiness_timeout)
+            if not loaded:
+                logger.warning(f"⚠️ CPU副本{replica.index}在{self.readiness_timeout}秒内未就绪")
+        self.started_at = time.time()
+        return {f"replica-{replica.index}": dict(replica.info) for replica in self.replicas}
+    
+    def _spawn(self, replica: CpuReplica) -> None:
+        parent_conn, child_conn = self._mp.Pipe()
+        replica.conn = parent_conn
+        replica.info = {}
+        replica.process = self._mp.Process(
+            target=self.replica_main,
+            args=(replica.index, self.model_path, replica.cpus, len(self.replicas), replica.memory_share, child_conn),
+            name=f"cpu-replica-{replica.index}",
+            daemon=True,
+        )
+        replica.process.start()
+        child_conn.close()
+        threading.Thread(target=self._receive, args=(replica,), name=f"cpu-replica-{replica.index}-reader", daemon=True).start()
+    
+    def _receive(self, replica: CpuReplica) -> None:
+        """读取一个副本进程的回传消息，进程退出时让其进行中的任务失败并重启副本"""
+        while True:
+            try:
+                kind, job_id, payload = replica.conn.recv()
+            except (EOFError, OSError):
+                break
+            if kind == "ready":
+                replica.info = payload
+                replica.ready.set()
+                logger.info(f"✅ CPU副本{replica.index}就绪: NUMA节点{replica.node}, {len(replica.cpus)}核, {payload}")
+                with self._cond:
+                    self._cond.notify_all()
+                continue
+            if kind == "failed":
+                replica.info = {"error": payload}
+                break
+            
+            job = replica.jobs.get(job_id)
+            if job is None:
+                continue
+            if kind == "start":
+                job.prompt_tokens = payload["prompt_tokens"]
+                job.history_window = payload["history"]
+                job.remote_submitted_at = payload["submitted_at"]
+                job.started_at = time.time()
+            elif kind == "piece":
+                piece, tokens = payload
+                if job.first_token_at is None:
+                    job.first_token_at = time.time()
+                job.completion_tokens.extend(tokens)
+                job.text += piece
+                job._emitted = len(job.text)
+                job._pieces.put(piece)
+            elif kind == "done":
+                job.completion_tokens = payload["completion_tokens"]
+                job.text = payload["text"]
+                job.remote_timing = payload["timing"]
+                job.cached = payload["cached"]
+                job.cache_info = payload["cache_info"]
+                self._complete(replica, job, payload["finish_reason"])
+            elif kind == "error":
+                self._complete(replica, job, "error", RuntimeError(payload))
+        
+        replica.ready.clear()
+        with self._lock:
+            orphans = list(replica.jobs.values())
+        for job in orphans:
+            self._complete(replica, job, "error", RuntimeError(f"CPU副本{replica.index}进程已退出"))
+        if replica.process is not None:
+            replica.process.join(timeout=5)
+        # 加载期间就退出的副本不再重启，避免反复崩溃
+        if not replica.info:
+            replica.info = {"error": f"加载期间进程退出(exitcode={replica.process.exitcode})"}
+        with self._cond:
+            self._cond.notify_all()
+        if self._closing or "error" in replica.info:
+            logger.error(f"❌ CPU副本{replica.index}已停止: {replica.info.get('error', '池已关闭')}")
+            return
+        logger.warning(f"⚠️ CPU副本{replica.index}进程退出(exitcode={replica.process.exitcode})，重新启动")
+        replica.restarts += 1
+        time.sleep(1)
+        # 其他副本仍占着各自的内存，按启动时的份额重新规划，不能把剩余内存全部拿走
+        self._spawn(replica)
+    
+    def _complete(self, replica: CpuReplica, job: ReplicaJob, reason: str, error: Optional[Exception] = None) -> None:
+        with self._cond:
+            if replica.jobs.pop(job.job_id, None) is None:
+                return
+            replica.completed += 1
+            replica.tokens += len(job.completion_tokens)
+            replica.mark_idle_if_done()
+            self._cond.notify_all()
+        job.finish(reason, error)
+    
+    def _route(self, timeout: float) -> CpuReplica:
+        """选进行中任务最少的就绪副本，相同时选累计忙碌时间少的；没有就绪副本时等待（调用方持有池锁）"""
+        if not self._cond.wait_for(lambda: any(replica.ready.is_set() for replica in self.replicas), timeout):
+            raise RuntimeError("CPU副本池没有就绪的副本")
+        ready = [replica for replica in self.replicas if replica.ready.is_set()]
+        return min(ready, key=lambda replica: (len(replica.jobs), replica.busy_seconds))
+    
+    def submit(self, input_data: Dict[str, Any], deadline: Optional[float] = None,
+               cancel_event: Optional[threading.Event] = None) -> Tuple[GenerationJob, Any, bool]:
+        """把请求路由到一个副本，相同任务正在进行时合并，返回(任务, 增量文本迭代器, 是否合并)"""
+        def start():
+            with self._cond:
+                replica = self._route(self.readiness_timeout)
+                self._next_job_id += 1
+                job = ReplicaJob(self._next_job_id)
+                job.replica = replica.index
+                job.model_name = self.name
+                job.persona = input_data.get("persona", "default")
+                job.watch(cancel_event, deadline)
+                replica.jobs[job.job_id] = job
+                replica.mark_busy()
+                self.routed += 1
+            try:
+                # 合并由路由进程负责，副本内不再重复检查
+                replica.send(("job", job.job_id, (dict(input_data, coalesce=False), deadline)))
+            except (OSError, ValueError) as e:
+                self._complete(replica, job, "error", RuntimeError(f"发送任务到CPU副本{replica.index}失败: {e}"))
+            logger.info(f"🧭 任务路由到CPU副本{replica.index} (进行中{len(replica.jobs)})")
+            return job, self._pieces(replica, job)
+        
+        if self.coalescer is None or input_data.get("coalesce") is False:
+            job, pieces = start()
+            return job, pieces, False
+        job, pieces, coalesced = self.coalescer.run(self.coalescer.fingerprint(self.model_path, input_data), start)
+        if coalesced:
+            job.watch(cancel_event, deadline)
+        return job, pieces, coalesced
+    
+    def _pieces(self, replica: CpuReplica, job: ReplicaJob):
+        """产出副本回传的增量文本；所有等待者取消或超时后通知副本停止"""
+        cancel_sent = False
+        while True:
+            try:
+                piece = job._pieces.get(timeout=0.1)
+            except queue.Empty:
+                if not cancel_sent and job.stop_reason():
+                    cancel_sent = True
+                    try:
+                        replica.send(("cancel", job.job_id, None))
+                    except (OSError, ValueError):
+                        pass
+                continue
+            if piece is None:
+                break
+            yield piece
+        
+        if self.histograms is not None:
+            self.histograms.observe(job)
+        logger.info(f"⚡ CPU副本{replica.index}生成完成: {job.timing()}, 用量: {job.usage()}, 结束原因: {job.finish_reason}")
+        if job.error:
+            raise job.error
+    
+    def close(self) -> None:
+        self._closing = True
+        for replica in self.replicas:
+            try:
+                replica.send(("close", None, None))
+            except (OSError, ValueError, AttributeError):
+                pass
+        for replica in self.replicas:
+            if replica.process is not None:
+                replica.process.join(timeout=10)
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            replicas = {f"replica-{replica.index}": replica.stats() for replica in self.replicas}
+        tokens = sum(replica["completion_tokens"] for replica in replicas.values())
+        uptime = time.time() - self.started_at
+        return {
+            "model": self.name,
+            "replicas": len(self.replicas),
+            "ready_replicas": sum(replica["ready"] for replica in replicas.values()),
+            "routed": self.routed,
+            "completion_tokens": tokens,
+            "tokens_per_second": round(tokens / uptime, 2) if uptime > 0 else 0.0,
+            "capacity_tokens_per_second": round(sum(replica["tokens_per_busy_second"] for replica in replicas.values()), 2),
+            "utilization": round(sum(replica["utilization"] for replica in replicas.values()) / len(replicas), 3) if replicas else 0.0,
+            "per_replica": replicas,
+        }
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""
+生成任务 - 采样参数解析、单条生成序列（停止词/重复循环检测/增量文本）、采样与延迟统计
+单序列路径、连续批处理调度器和CPU副本池共用
+"""
+
+import os
+import time
+import codecs
+import queue
+import logging
+import threading
+from collections import Counter, deque
+from typing import Optional, Dict, Any, Tuple, List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 生成长度 - 请求的max_tokens默认值与上限
+DEFAULT_MAX_TOKENS = int(os.environ.get("DEFAULT_MAX_TOKENS", "2048"))
+MAX_TOKENS_LIMIT = int(os.environ.get("MAX_TOKENS_LIMIT", "4096"))
+
+# 重复循环检测 - 最近的输出由周期<=N的片段重复至少M次且总长>=L个token时提前结束（0关闭）
+REPETITION_MAX_PERIOD = int(os.environ.get("REPETITION_MAX_PERIOD", "64"))
+REPETITION_MIN_REPEATS = int(os.environ.get("REPETITION_MIN_REPEATS", "4"))
+REPETITION_MIN_SPAN = int(os.environ.get("REPETITION_MIN_SPAN", "64"))
+
+STOP_STRINGS = ["<|eot_id|>", "<|end_of_text|>", "\n\n---", "<|start_header_id|>"]
+
+def sample_token(logits, temperature: float, top_k: int, top_p: float,
+                 repeat_penalty: float, recent_tokens: List[int], rng) -> int:
+    """按llama.cpp默认顺序采样：重复惩罚 -> top_k -> 温度 -> top_p"""
+    if repeat_penalty != 1.0 and recent_tokens:
+        idx = np.fromiter(set(recent_tokens), dtype=np.int64)
+        values = logits[idx]
+        logits[idx] = np.where(values > 0, values / repeat_penalty, values * repeat_penalty)
+    
+    if temperature <= 0:
+        return int(np.argmax(logits))
+    
+    if 0 < top_k < len(logits):
+        candidates = np.argpartition(logits, -top_k)[-top_k:]
+    else:
+        candidates = np.arange(len(logits))
+    scaled = logits[candidates] / temperature
+    order = np.argsort(-scaled)
+    candidates, scaled = candidates[order], scaled[order]
+    
+    probs = np.exp(scaled - scaled[0])
+    probs /= probs.sum()
+    if top_p < 1.0:
+        cutoff = int(np.searchsorted(np.cumsum(probs), top_p)) + 1
+        candidates, probs = candidates[:cutoff], probs[:cutoff] / probs[:cutoff].sum()
+    return int(rng.choice(candidates, p=probs))
+
+class RepetitionDetector:
+    """检测输出末尾的n-gram循环：对每个周期p维护"当前token与p个之前的token相同"的连续长度，
+    连续长度达到p*(M-1)即说明末尾的p个token已重复了M次，每个token只需O(最大周期)次比较
+    """
+    
+    def __init__(self, max_period: int, min_repeats: int, min_span: int):
+        self.max_period = max_period
+        self.min_repeats = max(2, min_repeats)
+        self.min_span = min_span
+        self.tokens: List[int] = []
+        self.runs = [0] * (max_period + 1)
+        self.period = 0
+    
+    def feed(self, token: int) -> bool:
+        """追加一个token，检测到循环时返回True"""
+        if self.max_period <= 0:
+            return False
+        self.tokens.append(token)
+        n = len(self.tokens)
+        for period in range(1, min(self.max_period, n - 1) + 1):
+            if self.tokens[n - 1 - period] == token:
+                self.runs[period] += 1
+            else:
+                self.runs[period] = 0
+                continue
+            repeats = self.runs[period] // period + 1
+            if repeats >= self.min_repeats and repeats * period >= self.min_span:
+                self.period = period
+                return True
+        return False
+
+finish_reasons = Counter()   # 各结束原因的任务数（stop/length/deadline/cancelled/error）
+
+class GenerationJob:
+    """一条生成序列：保存采样参数、已生成的token与文本，供单序列和批处理两种路径共用"""
+    
+    def __init__(self, prompt_tokens: List[int], max_tokens: int = 2048, temperature: float = 0.7,
+                 top_p: float = 0.9, top_k: int = 40, repeat_penalty: float = 1.1,
+                 stop: Optional[List[str]] = None, seed: Optional[int] = None):
+        self.prompt_tokens = list(prompt_tokens)
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.repeat_penalty = repeat_penalty
+        self.stop = stop if stop is not None else STOP_STRINGS
+        self.repetition = RepetitionDetector(REPETITION_MAX_PERIOD, REPETITION_MIN_REPEATS, REPETITION_MIN_SPAN)
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        
+        self.seq_id = None
+        self.n_past = 0                           # 已写入KV缓存的token数
+        self.pending = list(self.prompt_tokens)   # 下一步需要送入batch的token
+        self.completion_tokens: List[int] = []
+        self.text = ""
+        self.finish_reason = None
+        self.error = None
+        self.model_name = ""
+        self.persona = "default"
+        self.history_window = {}
+        self.speculative = "off"
+        self.draft_model_path = None
+        self.speculation = None   # 投机解码统计，由SpeculationTracker填写
+        self.cached = False       # 直接由响应缓存返回
+        self.batched = False      # 由连续批处理调度器生成（不复用前缀状态，不做投机解码）
+        self.warmup = False       # 启动预热任务，不计入延迟/结束原因/投机解码统计
+        self.conversation_id = None   # 带ID时每轮结束后写盘快照
+        self._watchers: List[Tuple[Optional[threading.Event], Optional[float]]] = []   # (取消事件, 截止时间)
+        self.cache_info = None    # 命中的缓存类型与相似度
+        
+        # 耗时分解：分词 -> 排队(等锁/等槽) -> 前缀恢复 -> 提示词计算 -> 逐token解码
+        self.tokenize_ms = 0.0
+        self.prefix_restore_ms = 0.0
+        self.reused_tokens = 0
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.first_token_at = None
+        self.finished_at = None
+        
+        self._emitted = 0
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self._pieces = queue.Queue()   # 增量文本，None表示结束
+        self._done = threading.Event()
+    
+    def append_token(self, token: int, piece: bytes) -> Optional[str]:
+        """追加一个token，命中停止词返回"stop"，陷入重复循环返回"repetition"，否则返回None"""
+        if self.first_token_at is None:
+            self.first_token_at = time.time()
+        self.completion_tokens.append(token)
+        self.text += self._decoder.decode(piece)
+        
+        for stop in self.stop:
+            index = self.text.find(stop, max(0, self._emitted - len(stop)))
+            if index != -1:
+                self.text = self.text[:index]
+                return "stop"
+        
+        if self.repetition.feed(token):
+            logger.warning(f"🔁 检测到重复循环: 周期{self.repetition.period} tokens，已生成{len(self.completion_tokens)} tokens，提前结束")
+            return "repetition"
+        
+        # 末尾可能是停止词的开头，先保留不输出
+        held = 0
+        for stop in self.stop:
+            for length in range(min(len(stop) - 1, len(self.text)), held, -1):
+                if self.text.endswith(stop[:length]):
+                    held = length
+                    break
+        safe = len(self.text) - held
+        if safe > self._emitted:
+            self._pieces.put(self.text[self._emitted:safe])
+            self._emitted = safe
+        return None
+    
+    def watch(self, cancel_event: Optional[threading.Event] = None, deadline: Optional[float] = None) -> None:
+        """登记一个等待该任务结果的请求（合并的重复请求各登记一次）"""
+        self._watchers.append((cancel_event, deadline))
+    
+    def stop_reason(self) -> Optional[str]:
+        """所有等待者都已取消或都已超过截止时间时返回结束原因，解码每一步之间调用"""
+        if not self._watchers:
+            return None
+        if all(event is not None and event.is_set() for event, _ in self._watchers):
+            return "cancelled"
+        deadlines = [deadline for _, deadline in self._watchers]
+        if None not in deadlines and time.time() > max(deadlines):
+            return "deadline"
+        return None
+    
+    def finish(self, reason: str, error: Optional[Exception] = None) -> None:
+        if not self.warmup:
+            finish_reasons[reason] += 1
+        self.finished_at = time.time()
+        self.finish_reason = reason
+        self.error = error
+        if len(self.text) > self._emitted:
+            self._pieces.put(self.text[self._emitted:])
+            self._emitted = len(self.text)
+        self._pieces.put(None)
+        self._done.set()
+    
+    def wait(self, timeout: Optional[float] = None) -> str:
+        self._done.wait(timeout)
+        if self.error:
+            raise self.error
+        return self.text
+    
+    def iter_pieces(self):
+        """阻塞读取增量文本直到任务结束（批处理路径）"""
+        while True:
+            piece = self._pieces.get()
+            if piece is None:
+                return
+            yield piece
+    
+    def take_pieces(self) -> List[str]:
+        """取出当前已就绪的增量文本，不阻塞（单序列路径）"""
+        pieces = []
+        while True:
+            try:
+                piece = self._pieces.get_nowait()
+            except queue.Empty:
+                return pieces
+            if piece is not None:
+                pieces.append(piece)
+    
+    @property
+    def deterministic(self) -> bool:
+        """贪心解码或固定seed时相同输入一定得到相同输出"""
+        return self.temperature <= 0 or self.seed is not None
+    
+    def sampling_params(self) -> Dict[str, Any]:
+        return {
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "top_k": self.top_k,
+            "repeat_penalty": self.repeat_penalty,
+            "stop": list(self.stop),
+            "seed": self.seed,
+        }
+    
+    def usage(self) -> Dict[str, int]:
+        return {
+            "prompt_tokens": len(self.prompt_tokens),
+            "completion_tokens": len(self.completion_tokens),
+            "total_tokens": len(self.prompt_tokens) + len(self.completion_tokens),
+        }
+    
+    def timing(self) -> Dict[str, float]:
+        """耗时分解（毫秒）与吞吐"""
+        end = self.finished_at or time.time()
+        started = self.started_at or self.submitted_at
+        timing = {
+            "tokenize_ms": round(self.tokenize_ms, 1),
+            "queue_ms": round((started - self.submitted_at) * 1000, 1),
+            "prefix_restore_ms": round(self.prefix_restore_ms, 1),
+            "total_ms": round(self.tokenize_ms + (end - self.submitted_at) * 1000, 1),
+        }
+        if self.first_token_at is not None:
+            # 首个token的时间包含整段提示词计算
+            prompt_eval_seconds = self.first_token_at - started - self.prefix_restore_ms / 1000
+            evaluated = len(self.prompt_tokens) - self.reused_tokens
+            timing["prompt_eval_ms"] = round(prompt_eval_seconds * 1000, 1)
+            if prompt_eval_seconds > 0:
+                timing["prompt_tokens_per_second"] = round(evaluated / prompt_eval_seconds, 2)
+            timing["time_to_first_token_ms"] = round(self.tokenize_ms + (self.first_token_at - self.submitted_at) * 1000, 1)
+            
+            decode_seconds = end - self.first_token_at
+            timing["decode_ms"] = round(decode_seconds * 1000, 1)
+            if decode_seconds > 0 and len(self.completion_tokens) > 1:
+                timing["decode_tokens_per_second"] = round((len(self.completion_tokens) - 1) / decode_seconds, 2)
+        if self.speculation:
+            timing["speculation"] = self.speculation
+        if self.batched:
+            timing["path"] = "batched"
+        return timing
+
+class LatencyHistograms:
+    """进程内延迟统计：按(模型, 人格)保留最近N个样本，按需计算p50/p95/p99"""
+    
+    TRACKED = ("tokenize_ms", "queue_ms", "prompt_eval_ms", "time_to_first_token_ms",
+               "decode_tokens_per_second", "total_ms")
+    
+    def __init__(self, window: int):
+        self.window = window
+        self._series = {}   # (模型, 人格, 指标) -> deque
+        self._counts = {}   # (模型, 人格) -> 请求数与token数
+        self._lock = threading.Lock()
+    
+    def observe(self, job: GenerationJob) -> None:
+        if job.warmup:
+            return
+        timing = job.timing()
+        group = (job.model_name, job.persona)
+        with self._lock:
+            counts = self._counts.setdefault(group, {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0})
+            counts["requests"] += 1
+            counts["prompt_tokens"] += len(job.prompt_tokens)
+            counts["completion_tokens"] += len(job.completion_tokens)
+            for metric in self.TRACKED:
+                if metric in timing:
+                    key = group + (metric,)
+                    if key not in self._series:
+                        self._series[key] = deque(maxlen=self.window)
+                    self._series[key].append(timing[metric])
+    
+    @staticmethod
+    def _percentile(ordered: List[float], q: float) -> float:
+        index = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+        return round(ordered[index], 2)
+    
+    def summary(self) -> Dict[str, Any]:
+        """{"模型/人格": {"requests":..., "ttft_ms": {"p50":..,"p95":..,"p99":..}, ...}}"""
+        with self._lock:
+            report = {}
+            for (model_name, persona), counts in self._counts.items():
+                report[f"{model_name}/{persona}"] = dict(counts)
+            for (model_name, persona, metric), values in self._series.items():
+                ordered = sorted(values)
+                report[f"{model_name}/{persona}"][metric] = {
+                    "p50": self._percentile(ordered, 0.50),
+                    "p95": self._percentile(ordered, 0.95),
+                    "p99": self._percentile(ordered, 0.99),
+                    "samples": len(ordered),
+                }
+            return report
+
+def parse_sampling_params(input_data: Dict[str, Any]) -> Dict[str, Any]:
+    """读取并校验请求里的生成预算与采样参数，未给出或为null的使用默认值，类型不对时抛出ValueError"""
+    
+    def number(key: str, default, cast=float):
+        value = input_data.get(key)
+        if value is None:
+            return default
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{key}必须是数字，收到: {value!r}")
+    
+    max_tokens = number("max_tokens", DEFAULT_MAX_TOKENS, int) or DEFAULT_MAX_TOKENS
+    if max_tokens > MAX_TOKENS_LIMIT:
+        logger.warning(f"⚠️ max_tokens={max_tokens}超过上限，按{MAX_TOKENS_LIMIT}处理")
+    stop = input_data.get("stop") or []
+    if isinstance(stop, str):
+        stop = [stop]
+    if not isinstance(stop, list):
+        raise ValueError(f"stop必须是字符串或字符串列表，收到: {stop!r}")
+    return {
+        "max_tokens": max(1, min(max_tokens, MAX_TOKENS_LIMIT)),
+        "temperature": max(0.0, number("temperature", 0.7)),
+        "top_p": min(1.0, max(0.0, number("top_p", 0.9))),
+        "top_k": max(0, number("top_k", 40, int)),
+        "repeat_penalty": number("repeat_penalty", 1.1),
+        "stop": [str(s) for s in stop if s],
+        "seed": number("seed", None, int),
+    }
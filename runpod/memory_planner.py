@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+GGUF显存/内存规划 - 只读取GGUF头估算权重、KV缓存与计算缓冲，选出放得下的上下文、卸载层数与KV类型
+不依赖llama_cpp，离线也可以对模型文件做规划
+"""
+
+import re
+import struct
+from typing import Optional, Dict, Any, List
+
+# GGUF元数据值类型 -> struct格式（8=字符串, 9=数组单独处理）
+GGUF_VALUE_FORMATS = {0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i", 6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d"}
+
+# ggml张量类型 -> (每块元素数, 每块字节数)
+GGML_TYPE_SIZES = {
+    0: (1, 4), 1: (1, 2), 2: (32, 18), 3: (32, 20), 6: (32, 22), 7: (32, 24), 8: (32, 34), 9: (32, 36),
+    10: (256, 84), 11: (256, 110), 12: (256, 144), 13: (256, 176), 14: (256, 210), 15: (256, 292),
+    16: (256, 66), 17: (256, 74), 18: (256, 98), 19: (256, 50), 20: (32, 18), 21: (256, 110),
+    22: (256, 82), 23: (256, 136), 24: (1, 1), 25: (1, 2), 26: (1, 4), 27: (1, 8), 28: (1, 8),
+    29: (256, 56), 30: (1, 2), 34: (256, 54), 35: (256, 66), 39: (32, 17),
+}
+
+# KV缓存类型 -> 每个元素字节数
+KV_TYPE_BYTES = {"f32": 4.0, "f16": 2.0, "bf16": 2.0, "q8_0": 34 / 32, "q5_1": 24 / 32, "q5_0": 22 / 32, "q4_1": 20 / 32, "q4_0": 18 / 32}
+
+def read_gguf_header(f, max_array_items: int = 1024) -> Dict[str, Any]:
+    """只读取GGUF头（元数据和张量信息），不读权重；超长数组（词表等）跳过内容"""
+    def read(fmt):
+        return struct.unpack(fmt, f.read(struct.calcsize(fmt)))[0]
+    
+    def read_string():
+        return f.read(read("<Q")).decode("utf-8", errors="replace")
+    
+    def read_value(value_type):
+        if value_type == 8:
+            return read_string()
+        if value_type == 9:
+            item_type, count = read("<I"), read("<Q")
+            if count > max_array_items:
+                if item_type in GGUF_VALUE_FORMATS:
+                    f.seek(count * struct.calcsize(GGUF_VALUE_FORMATS[item_type]), 1)
+                else:
+                    for _ in range(count):
+                        read_value(item_type)
+                return None
+            return [read_value(item_type) for _ in range(count)]
+        if value_type not in GGUF_VALUE_FORMATS:
+            raise ValueError(f"未知的GGUF元数据类型: {value_type}")
+        return read(GGUF_VALUE_FORMATS[value_type])
+    
+    if f.read(4) != b"GGUF":
+        raise ValueError("不是GGUF文件")
+    version = read("<I")
+    if version < 2:
+        raise ValueError(f"不支持的GGUF版本: {version}")
+    n_tensors, n_kv = read("<Q"), read("<Q")
+    
+    metadata = {}
+    for _ in range(n_kv):
+        key = read_string()
+        metadata[key] = read_value(read("<I"))
+    
+    tensors = {}
+    for _ in range(n_tensors):
+        name = read_string()
+        dims = [read("<Q") for _ in range(read("<I"))]
+        ggml_type = read("<I")
+        read("<Q")  # 数据偏移
+        if ggml_type not in GGML_TYPE_SIZES:
+            raise ValueError(f"未知的ggml张量类型: {ggml_type} ({name})")
+        block, block_bytes = GGML_TYPE_SIZES[ggml_type]
+        elements = 1
+        for dim in dims:
+            elements *= dim
+        tensors[name] = (dims, elements // block * block_bytes)
+    return {"version": version, "metadata": metadata, "tensors": tensors}
+
+def gguf_model_geometry(header: Dict[str, Any]) -> Dict[str, Any]:
+    """从GGUF头提取估算显存需要的模型结构与各部分权重大小"""
+    metadata = header["metadata"]
+    arch = metadata.get("general.architecture", "llama")
+    
+    def get(key, default=None):
+        value = metadata.get(f"{arch}.{key}", default)
+        # 每层不同的头数按最大值估算
+        return max(value) if isinstance(value, list) else value
+    
+    n_layer = get("block_count")
+    n_embd = get("embedding_length")
+    n_head = get("attention.head_count")
+    if not (n_layer and n_embd and n_head):
+        raise ValueError(f"GGUF缺少{arch}的结构元数据")
+    n_head_kv = get("attention.head_count_kv", n_head)
+    
+    layer_bytes = [0] * n_layer
+    input_bytes = output_bytes = 0
+    n_vocab = get("vocab_size", 0)
+    for name, (dims, size) in header["tensors"].items():
+        match = re.match(r"blk\.(\d+)\.", name)
+        if match and int(match.group(1)) < n_layer:
+            layer_bytes[int(match.group(1))] += size
+        elif name.startswith("token_embd"):
+            input_bytes += size
+            n_vocab = n_vocab or (dims[-1] if dims else 0)
+        else:
+            output_bytes += size
+    
+    return {
+        "arch": arch,
+        "n_layer": n_layer,
+        "n_embd": n_embd,
+        "n_head": n_head,
+        "n_head_kv": n_head_kv,
+        "key_length": get("attention.key_length", n_embd // n_head),
+        "value_length": get("attention.value_length", n_embd // n_head),
+        "n_ctx_train": get("context_length", 4096),
+        "n_vocab": n_vocab,
+        "layer_bytes": layer_bytes,
+        "input_bytes": input_bytes,
+        "output_bytes": output_bytes,
+    }
+
+def estimate_memory(geometry: Dict[str, Any], n_ctx: int, n_gpu_layers: int, kv_type: str = "f16",
+                    n_batch: int = 512, flash_attn: bool = False, logits_all: bool = False,
+                    batch_ctx: int = 0) -> Dict[str, int]:
+    """估算某个配置在GPU和主机上各需要多少字节
+    
+    与llama.cpp一致：卸载从最后一层开始，n_gpu_layers超过层数时输出层也放到GPU，
+    输入embedding始终留在主机；计算缓冲按一个ubatch的logits、激活和（未用flash attention时）KQ矩阵估算。
+    batch_ctx是连续批处理调度器另建的多序列上下文长度，它有自己的KV缓存和计算缓冲。
+    """
+    n_layer = geometry["n_layer"]
+    offload = n_layer + 1 if n_gpu_layers < 0 else min(n_gpu_layers, n_layer + 1)
+    gpu_layers = min(offload, n_layer)
+    
+    layer_bytes = geometry["layer_bytes"]
+    gpu_weights = sum(layer_bytes[n_layer - gpu_layers:]) + (geometry["output_bytes"] if offload > n_layer else 0)
+    total_weights = sum(layer_bytes) + geometry["input_bytes"] + geometry["output_bytes"]
+    
+    kv_per_layer = int((n_ctx + batch_ctx) * geometry["n_head_kv"] * (geometry["key_length"] + geometry["value_length"])
+                       * KV_TYPE_BYTES[kv_type])
+    
+    n_ubatch = min(n_batch, 512)
+    scratch = 0
+    for context in [n_ctx] + ([batch_ctx] if batch_ctx else []):
+        scratch += n_ubatch * geometry["n_vocab"] * 4 + n_ubatch * geometry["n_embd"] * 4 * 16
+        if not flash_attn:
+            scratch += context * n_ubatch * geometry["n_head"] * 4
+    
+    # logits_all时主机上为每个上下文位置保留一行logits
+    host_logits = (n_ctx if logits_all else n_batch) * geometry["n_vocab"] * 4
+    
+    return {
+        "gpu_weights": gpu_weights,
+        "cpu_weights": total_weights - gpu_weights,
+        "gpu_kv": kv_per_layer * gpu_layers,
+        "cpu_kv": kv_per_layer * (n_layer - gpu_layers),
+        "scratch": scratch,
+        "gpu_bytes": gpu_weights + kv_per_layer * gpu_layers + (scratch if gpu_layers else 0),
+        "cpu_bytes": total_weights - gpu_weights + kv_per_layer * (n_layer - gpu_layers) + (0 if gpu_layers else scratch) + host_logits,
+    }
+
+def plan_model_memory(geometry: Dict[str, Any], gpu_budget: Optional[int], host_budget: Optional[int],
+                      kv_types: List[str] = None, n_batch: int = 512, min_ctx: int = 4096, max_ctx: int = 32768,
+                      flash_attn: bool = False, logits_all: bool = False, batch_ctx: int = 0) -> Dict[str, Any]:
+    """选择放得下的最大配置：优先全部卸载到GPU，其次更长上下文，最后更高精度KV缓存
+    
+    全部卸载放不下min_ctx时才逐层减少卸载层数；没有GPU(gpu_budget为None)时只在主机内存内选上下文。
+    预算为None表示不限制。
+    """
+    kv_types = kv_types or ["f16"]
+    n_ctx_max = min(max_ctx, geometry["n_ctx_train"])
+    contexts = sorted({n_ctx_max} | {c for c in (131072, 98304, 65536, 49152, 32768, 16384, 8192, 4096, 2048, 1024) if c <= n_ctx_max}, reverse=True)
+    
+    def fits(estimate):
+        return ((gpu_budget is None or estimate["gpu_bytes"] <= gpu_budget)
+                and (host_budget is None or estimate["cpu_bytes"] <= host_budget))
+    
+    def search(layer_options, context_options):
+        for n_gpu_layers in layer_options:
+            for n_ctx in context_options:
+                for kv_type in kv_types:
+                    estimate = estimate_memory(geometry, n_ctx, n_gpu_layers, kv_type, n_batch, flash_attn, logits_all, batch_ctx)
+                    if fits(estimate):
+                        return {"n_ctx": n_ctx, "n_gpu_layers": n_gpu_layers, "kv_type": kv_type, "fits": True, **estimate}
+        return None
+    
+    n_layer = geometry["n_layer"]
+    if gpu_budget is not None:
+        plan = (search([-1], [c for c in contexts if c >= min_ctx])
+                or search(range(n_layer, 0, -1), [c for c in contexts if c >= min_ctx])
+                or search([-1] + list(range(n_layer, 0, -1)), contexts))
+        if plan:
+            return plan
+    plan = search([0], contexts)
+    if plan:
+        return plan
+    
+    # 怎么都放不下时返回最小配置，由调用方决定是否仍然尝试
+    smallest = estimate_memory(geometry, contexts[-1], 0, kv_types[-1], n_batch, flash_attn, logits_all, batch_ctx)
+    return {"n_ctx": contexts[-1], "n_gpu_layers": 0, "kv_type": kv_types[-1], "fits": False, **smallest}
+
+# KV缓存类型名 -> ggml类型编号（Llama的type_k/type_v参数）
+GGML_TYPE_IDS = {"f32": 0, "f16": 1, "q4_0": 2, "q4_1": 3, "q5_0": 6, "q5_1": 7, "q8_0": 8, "bf16": 30}
@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+"""
+语音转文字 - Whisper/CTranslate2引擎、内存中音频解码、短语音微批处理与长音频VAD分段
+"""
+
+import os
+import time
+import queue
+import logging
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import Future, as_completed
+from typing import Optional, Dict, Any, Tuple, List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 当前加载的STT引擎（由whisper_lock保护）
+stt_engine = None
+stt_ready = threading.Event()   # STT预加载结束后置位，之前到达的语音任务在此等待
+stt_ready.set()   # 未启用预加载时（例如被其他脚本导入）不阻塞
+
+# Whisper输入采样率
+WHISPER_SAMPLE_RATE = 16000
+
+# 长音频VAD分段转写 - 超过N秒自动启用（请求里的vad字段可强制开关）
+STT_VAD_MIN_SECONDS = float(os.environ.get("STT_VAD_MIN_SECONDS", "30"))
+STT_VAD_FRAME_MS = 30
+STT_VAD_MIN_SILENCE_MS = int(os.environ.get("STT_VAD_MIN_SILENCE_MS", "500"))
+STT_VAD_MAX_SEGMENT_SECONDS = int(os.environ.get("STT_VAD_MAX_SEGMENT_SECONDS", "28"))
+STT_VAD_PAD_MS = int(os.environ.get("STT_VAD_PAD_MS", "200"))
+STT_VAD_THRESHOLD_RATIO = float(os.environ.get("STT_VAD_THRESHOLD_RATIO", "3.0"))
+
+# STT引擎 - whisper(openai-whisper) / ctranslate2(faster-whisper, int8量化) / auto按模型格式选择
+STT_ENGINE = os.environ.get("STT_ENGINE", "auto")
+STT_COMPUTE_TYPE = os.environ.get("STT_COMPUTE_TYPE", "")   # 为空时CPU用int8，GPU用int8_float16
+STT_CPU_THREADS = int(os.environ.get("STT_CPU_THREADS", "0"))
+STT_PRELOAD_PATH = os.environ.get("STT_PRELOAD_PATH", "/runpod-volume/voice/whisper-large-v3-turbo")
+WHISPER_DOWNLOAD_ROOT = os.environ.get("WHISPER_DOWNLOAD_ROOT", "/runpod-volume/voice")
+
+# STT微批处理 - 批大小为1时关闭；最多等待N毫秒凑批
+STT_BATCH_SIZE = int(os.environ.get("STT_BATCH_SIZE", "8"))
+STT_BATCH_WAIT_MS = float(os.environ.get("STT_BATCH_WAIT_MS", "50"))
+
+whisper_lock = threading.Lock()
+
+class SpeechEngine:
+    """STT引擎接口：load()只从本地加载模型，transcribe*()对16kHz float32 PCM推理"""
+    
+    name = "base"
+    
+    def __init__(self, model_path: str):
+        self.model_path = model_path
+        self.model = None
+        self.load_seconds = 0.0
+    
+    def load(self) -> None:
+        raise NotImplementedError
+    
+    def transcribe(self, audio: "np.ndarray", language: str = "auto", task: str = "transcribe") -> Tuple[str, str]:
+        """返回(文本, 检测到的语言)"""
+        raise NotImplementedError
+    
+    def transcribe_batch(self, clips: list, language: str = "auto", task: str = "transcribe") -> List[Tuple[str, str]]:
+        """默认逐条推理，支持批量解码的引擎可以覆盖"""
+        return [self.transcribe(audio, language, task) for audio in clips]
+
+class WhisperEngine(SpeechEngine):
+    """openai-whisper (PyTorch fp32/fp16) 引擎"""
+    
+    name = "whisper"
+    
+    def load(self) -> None:
+        import whisper
+        
+        # 标准模型名称只从本地下载目录读取，不联网下载
+        checkpoint = self.model_path
+        if not os.path.exists(checkpoint):
+            checkpoint = os.path.join(WHISPER_DOWNLOAD_ROOT, f"{self.model_path}.pt")
+        if not os.path.isfile(checkpoint):
+            raise FileNotFoundError(f"本地没有Whisper检查点: {self.model_path}")
+        self.model = whisper.load_model(checkpoint)
+    
+    def transcribe(self, audio, language="auto", task="transcribe"):
+        # task=translate时直接翻译到英语
+        options = {"task": task}
+        if language != "auto":
+            options["language"] = language
+        result = self.model.transcribe(audio, **options)
+        return result.get("text", "").strip(), result.get("language", "unknown")
+    
+    def transcribe_batch(self, clips, language="auto", task="transcribe"):
+        """补齐到30秒mel窗口后一次完成编码和解码"""
+        import torch
+        import whisper
+        
+        device = self.model.device
+        mel = torch.stack([
+            whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), n_mels=self.model.dims.n_mels)
+            for audio in clips
+        ]).to(device)
+        options = whisper.DecodingOptions(
+            task=task,
+            language=None if language == "auto" else language,
+            fp16=device.type == "cuda",
+        )
+        results = whisper.decode(self.model, mel, options)
+        return [(result.text.strip(), result.language) for result in results]
+
+class CTranslate2Engine(SpeechEngine):
+    """faster-whisper (CTranslate2) 引擎，CPU上默认int8量化"""
+    
+    name = "ctranslate2"
+    
+    def _model_dir(self) -> str:
+        """CTranslate2模型目录；Hugging Face格式的模型使用旁边由convert_stt_model.py离线转换的目录
+        
+        转换需要transformers/torch且耗时数分钟，不在worker加载时进行。
+        """
+        if os.path.exists(os.path.join(self.model_path, "model.bin")):
+            return self.model_path
+        converted = f"{self.model_path.rstrip('/')}-ct2-int8"
+        if os.path.exists(os.path.join(converted, "model.bin")):
+            return converted
+        raise FileNotFoundError(
+            f"没有CTranslate2格式的Whisper模型: {self.model_path}，"
+            f"请先运行 python3 convert_stt_model.py {self.model_path} 生成{converted}，或设置STT_ENGINE=whisper"
+        )
+    
+    def load(self) -> None:
+        import ctranslate2
+        from faster_whisper import WhisperModel
+        
+        device = "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+        compute_type = STT_COMPUTE_TYPE or ("int8_float16" if device == "cuda" else "int8")
+        logger.info(f"🎤 CTranslate2引擎: device={device}, compute_type={compute_type}")
+        self.model = WhisperModel(
+            self._model_dir(),
+            device=device,
+            compute_type=compute_type,
+            cpu_threads=STT_CPU_THREADS,
+            local_files_only=True,
+        )
+    
+    def transcribe(self, audio, language="auto", task="transcribe"):
+        segments, info = self.model.transcribe(
+            audio,
+            language=None if language == "auto" else language,
+            task=task,
+        )
+        return "".join(segment.text for segment in segments).strip(), info.language
+    
+    def transcribe_batch(self, clips, language="auto", task="transcribe"):
+        """补齐到30秒特征窗口后一次编码，按语音各自的语言构造提示一次批量解码"""
+        from faster_whisper.tokenizer import Tokenizer
+        
+        # 先把音频补零到30秒再提取特征，与单条转写的静音填充一致
+        extractor = self.model.feature_extractor
+        features = [
+            extractor(np.pad(audio, (0, max(0, extractor.n_samples - len(audio)))))[:, :extractor.nb_max_frames]
+            for audio in clips
+        ]
+        encoder_output = self.model.encode(np.stack(features))
+        
+        multilingual = self.model.model.is_multilingual
+        if not multilingual:
+            languages = ["en"] * len(clips)
+        elif language == "auto":
+            # detect_language对每条语音返回按概率排序的[("<|zh|>", p), ...]
+            languages = [ranked[0][0][2:-2] for ranked in self.model.model.detect_language(encoder_output)]
+        else:
+            languages = [language] * len(clips)
+        
+        prompts = []
+        tokenizers = []
+        for clip_language in languages:
+            tokenizer = Tokenizer(self.model.hf_tokenizer, multilingual, task=task, language=clip_language)
+            tokenizers.append(tokenizer)
+            prompts.append(list(tokenizer.sot_sequence) + [tokenizer.no_timestamps])
+        
+        results = self.model.model.generate(encoder_output, prompts, beam_size=1, max_length=448, suppress_blank=True)
+        return [
+            (tokenizer.decode(result.sequences_ids[0]).strip(), clip_language)
+            for tokenizer, result, clip_language in zip(tokenizers, results, languages)
+        ]
+
+STT_ENGINES = {
+    "whisper": WhisperEngine,
+    "ctranslate2": CTranslate2Engine,
+}
+
+def create_stt_engine(model_path: str) -> SpeechEngine:
+    """按STT_ENGINE创建引擎；auto时.pt文件和标准名称用whisper，模型目录用ctranslate2"""
+    engine_name = STT_ENGINE
+    if engine_name == "auto":
+        engine_name = "ctranslate2" if os.path.isdir(model_path) else "whisper"
+    if engine_name not in STT_ENGINES:
+        raise ValueError(f"未知的STT引擎: {engine_name}")
+    return STT_ENGINES[engine_name](model_path)
+
+def load_stt_engine(model_path: str) -> bool:
+    """加载STT模型（调用方持有whisper_lock），失败时不再联网下载备用模型"""
+    global stt_engine
+    
+    try:
+        engine = create_stt_engine(model_path)
+        logger.info(f"🎤 开始加载STT模型: {model_path} (引擎: {engine.name})")
+        start = time.time()
+        engine.load()
+        engine.load_seconds = time.time() - start
+        
+        stt_engine = engine
+        logger.info(f"✅ STT模型加载成功: {os.path.basename(model_path)}, 耗时{engine.load_seconds:.1f}秒")
+        return True
+        
+    except Exception as e:
+        logger.error(f"❌ STT模型加载失败: {e}")
+        return False
+
+def ensure_stt_engine(model_path: str) -> None:
+    """确保指定的STT模型已加载（调用方持有whisper_lock）"""
+    if stt_engine is None or stt_engine.model_path != model_path:
+        logger.info(f"🔄 切换或加载STT模型: {model_path}")
+        if not load_stt_engine(model_path):
+            raise RuntimeError("STT模型加载失败")
+
+def preload_stt_engine(model_path: str) -> None:
+    """后台预加载STT模型，结束后（无论成败）打开STT就绪闸门"""
+    try:
+        with whisper_lock:
+            ensure_stt_engine(model_path)
+    except Exception as e:
+        logger.error(f"❌ STT预加载失败: {e}")
+    finally:
+        stt_ready.set()
+
+def wait_until_stt_ready(timeout: float) -> None:
+    """STT就绪闸门：预加载期间到达的语音任务等待预加载结束，而不是抢着加载模型"""
+    if not stt_ready.is_set():
+        logger.info("⏳ 等待STT模型预加载完成...")
+        if not stt_ready.wait(timeout):
+            logger.warning(f"⚠️ 等待STT预加载超过{timeout}秒，直接处理请求")
+
+def decode_audio(audio_bytes: bytes, sample_rate: int = WHISPER_SAMPLE_RATE) -> "np.ndarray":
+    """在内存中解码音频：字节通过stdin送入ffmpeg，从stdout读取16kHz单声道float32 PCM，不落盘
+    
+    stdin不能seek，moov atom在文件末尾的MP4/M4A（iOS/Safari录音）从管道解码会失败，此时改为写临时文件再解码。
+    """
+    def run_ffmpeg(source: str, stdin_bytes: Optional[bytes]) -> subprocess.CompletedProcess:
+        command = [
+            "ffmpeg", "-loglevel", "error", "-threads", "0",
+            "-i", source,
+            "-f", "f32le", "-acodec", "pcm_f32le", "-ac", "1", "-ar", str(sample_rate),
+            "pipe:1",
+        ]
+        return subprocess.run(command, input=stdin_bytes, capture_output=True)
+    
+    result = run_ffmpeg("pipe:0", audio_bytes)
+    if result.returncode != 0 or not result.stdout:
+        logger.info("ℹ️ 管道解码失败，改用临时文件解码")
+        # 优先放在内存文件系统，避免写磁盘
+        temp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        with tempfile.NamedTemporaryFile(dir=temp_dir, suffix=".audio") as f:
+            f.write(audio_bytes)
+            f.flush()
+            result = run_ffmpeg(f.name, None)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg解码失败: {result.stderr.decode('utf-8', errors='ignore').strip()[-500:]}")
+    return np.frombuffer(result.stdout, dtype=np.float32)
+
+def transcribe_audio(audio: "np.ndarray", language: str = "auto", task: str = "transcribe") -> Tuple[str, str]:
+    """对已解码的PCM进行转写或翻译（一次推理），返回(文本, 检测到的语言)"""
+    try:
+        if stt_engine is None:
+            raise Exception("STT模型未加载")
+        
+        logger.info(f"🎤 开始语音转文字，时长: {len(audio) / WHISPER_SAMPLE_RATE:.1f}秒, 语言: {language}, 任务: {task}")
+        transcription, detected_language = stt_engine.transcribe(audio, language, task)
+        
+        logger.info(f"✅ 语音转文字成功: '{transcription}' (检测语言: {detected_language})")
+        return transcription, detected_language
+                
+    except Exception as e:
+        logger.error(f"❌ 语音转文字失败: {e}")
+        raise e
+
+class SpeechBatcher:
+    """STT微批处理：收集短时间窗口内到达的短语音，补齐到相同mel长度后一次完成编码和解码"""
+    
+    def __init__(self, max_batch: int, max_wait_ms: float):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.clips = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_batch > 1
+    
+    def submit(self, audio: "np.ndarray", model_path: str, language: str, task: str) -> Future:
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="speech-batcher", daemon=True)
+                self._thread.start()
+        future = Future()
+        self._queue.put((audio, (model_path, language, task), future))
+        return future
+    
+    def _collect(self) -> list:
+        """阻塞等待第一条，然后在max_wait内尽量凑满一批"""
+        batch = [self._queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+    
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            
+            # 模型、语言和任务相同的语音才能共用一次解码
+            groups = {}
+            for audio, key, future in batch:
+                groups.setdefault(key, []).append((audio, future))
+            
+            for (model_path, language, task), items in groups.items():
+                try:
+                    results = self._decode(model_path, language, task, [audio for audio, _ in items])
+                    for (_, future), result in zip(items, results):
+                        future.set_result(result)
+                except Exception as e:
+                    logger.error(f"❌ STT批处理失败: {e}")
+                    for _, future in items:
+                        future.set_exception(e)
+    
+    def _decode(self, model_path: str, language: str, task: str, clips: list) -> List[Tuple[str, str]]:
+        with whisper_lock:
+            ensure_stt_engine(model_path)
+            results = stt_engine.transcribe_batch(clips, language, task)
+        
+        self.batches += 1
+        self.clips += len(clips)
+        logger.info(f"🎤 STT批处理完成: {len(clips)}条语音")
+        return results
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": self.batches,
+            "clips": self.clips,
+            "avg_batch_size": round(self.clips / self.batches, 2) if self.batches else 0.0,
+            "queued": self._queue.qsize(),
+        }
+
+speech_batcher = SpeechBatcher(STT_BATCH_SIZE, STT_BATCH_WAIT_MS)
+
+def transcribe_clip(audio: "np.ndarray", model_path: str, language: str = "auto", task: str = "transcribe") -> Tuple[str, str]:
+    """转写一段已解码的语音：不超过30秒的走微批处理，更长的单独完整转写"""
+    if speech_batcher.enabled and len(audio) <= WHISPER_SAMPLE_RATE * 30:
+        return speech_batcher.submit(audio, model_path, language, task).result()
+    
+    with whisper_lock:
+        ensure_stt_engine(model_path)
+        return transcribe_audio(audio, language, task)
+
+def detect_speech_segments(audio: "np.ndarray", sample_rate: int = WHISPER_SAMPLE_RATE) -> List[Tuple[int, int]]:
+    """基于短时能量的语音活动检测：在足够长的静音处切分，超长语音段在能量最低处再切，返回(起点, 终点)采样下标"""
+    frame = sample_rate * STT_VAD_FRAME_MS // 1000
+    n_frames = len(audio) // frame
+    if n_frames == 0:
+        return [(0, len(audio))] if len(audio) else []
+    
+    energy = np.sqrt(np.mean(audio[:n_frames * frame].reshape(n_frames, frame) ** 2, axis=1))
+    # 阈值取噪声底的若干倍，但不超过响亮部分的-20dB，避免几乎没有静音的录音被整段判为静音
+    noise_floor, loud = np.percentile(energy, [5, 95])
+    threshold = max(min(noise_floor * STT_VAD_THRESHOLD_RATIO, loud * 0.1), 1e-4)
+    is_speech = energy > threshold
+    
+    # 短于min_silence的停顿视为语音，避免在词与词之间切断
+    min_silence = max(1, STT_VAD_MIN_SILENCE_MS // STT_VAD_FRAME_MS)
+    regions = []
+    start = None
+    silence = 0
+    for i, speech in enumerate(is_speech):
+        if speech:
+            if start is None:
+                start = i
+            silence = 0
+        elif start is not None:
+            silence += 1
+            if silence >= min_silence:
+                regions.append((start, i - silence + 1))
+                start, silence = None, 0
+    if start is not None:
+        regions.append((start, n_frames - silence))
+    
+    # 超过上限的语音段在后半段能量最低的帧处继续切分
+    max_frames = STT_VAD_MAX_SEGMENT_SECONDS * 1000 // STT_VAD_FRAME_MS
+    pad = STT_VAD_PAD_MS // STT_VAD_FRAME_MS
+    segments = []
+    for start, end in regions:
+        while end - start > max_frames:
+            search_from = start + max_frames // 2
+            window = energy[search_from:start + max_frames]
+            cut = search_from + len(window) - 1 - int(np.argmin(window[::-1]))  # 能量相同时取最靠后的帧
+            segments.append((start, cut))
+            start = cut
+        segments.append((start, end))
+    
+    # 两端各留一点余量，但不与相邻语音段重叠
+    padded = []
+    previous_end = 0
+    for index, (start, end) in enumerate(segments):
+        next_start = segments[index + 1][0] if index + 1 < len(segments) else n_frames
+        start = max(previous_end, start - pad)
+        end = min(next_start, end + pad)
+        padded.append((start * frame, min(len(audio), end * frame)))
+        previous_end = end
+    return padded
+
+def transcribe_segments(audio: "np.ndarray", model_path: str, language: str = "auto", task: str = "transcribe"):
+    """VAD切分后把所有语音段一起交给微批处理器并行转写，按完成顺序产出带时间戳的段结果"""
+    segments = detect_speech_segments(audio)
+    logger.info(f"🎤 VAD切分: {len(audio) / WHISPER_SAMPLE_RATE:.1f}秒音频 -> {len(segments)}个语音段")
+    
+    futures = {
+        speech_batcher.submit(audio[start:end], model_path, language, task): (index, start, end)
+        for index, (start, end) in enumerate(segments)
+    }
+    for future in as_completed(futures):
+        index, start, end = futures[future]
+        text, detected_language = future.result()
+        yield {
+            "index": index,
+            "start": round(start / WHISPER_SAMPLE_RATE, 2),
+            "end": round(end / WHISPER_SAMPLE_RATE, 2),
+            "text": text,
+            "language": detected_language,
+        }
+
+def most_common_language(segments: List[Dict[str, Any]]) -> str:
+    languages = [segment["language"] for segment in segments if segment.get("text")]
+    return max(set(languages), key=languages.count) if languages else "unknown"
+
+def join_segment_texts(segments: List[Dict[str, Any]], language: str) -> str:
+    """按顺序拼接各段文本，中日文不加空格"""
+    separator = "" if language in ("zh", "ja", "yue") else " "
+    return separator.join(segment["text"] for segment in segments if segment["text"]).strip()
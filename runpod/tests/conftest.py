@@ -0,0 +1,5 @@
+import os
+import sys
+
+# handler模块是runpod/下的扁平脚本，不是包
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
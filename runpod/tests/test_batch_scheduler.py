@@ -0,0 +1,52 @@
+"""连续批处理调度器：CPU上用小型GGUF模型检查总吞吐随并发提升
+
+需要llama-cpp-python和一个小模型，未设置TEST_GGUF_MODEL时跳过：
+    TEST_GGUF_MODEL=/path/to/tiny.gguf python3 -m pytest runpod/tests/test_batch_scheduler.py
+"""
+
+import os
+import time
+
+import pytest
+
+MODEL = os.environ.get("TEST_GGUF_MODEL", "")
+
+pytestmark = pytest.mark.skipif(not MODEL, reason="未设置TEST_GGUF_MODEL")
+
+
+@pytest.fixture(scope="module")
+def handler():
+    pytest.importorskip("llama_cpp")
+    pytest.importorskip("runpod")
+    os.environ.setdefault("WARMUP_ENABLED", "0")
+    import handler_llama_ai
+    return handler_llama_ai
+
+
+def tokens_per_second(scheduler, h, prompt_tokens, concurrency, max_tokens=32):
+    start = time.time()
+    jobs = [
+        scheduler.submit(h.GenerationJob(prompt_tokens, max_tokens=max_tokens, temperature=0, stop=[]))
+        for _ in range(concurrency)
+    ]
+    for job in jobs:
+        job.wait(timeout=300)
+        assert job.finish_reason in ("length", "stop"), job.error
+    return sum(len(job.completion_tokens) for job in jobs) / (time.time() - start)
+
+
+def test_throughput_rises_with_concurrency(handler):
+    from caches import tokenize_text
+
+    h = handler
+    resident = h.model_registry.get(MODEL)
+    scheduler = h.BatchScheduler(resident.llm, 4, 512)
+    try:
+        prompt_tokens = tokenize_text(resident.llm, h.format_prompt("Write a short story about a robot."))
+        tokens_per_second(scheduler, h, prompt_tokens, 1, max_tokens=4)   # 预热
+        single = tokens_per_second(scheduler, h, prompt_tokens, 1)
+        batched = tokens_per_second(scheduler, h, prompt_tokens, 4)
+    finally:
+        scheduler.close()
+    assert batched > single, f"并发4总吞吐{batched:.1f} tokens/s，单序列{single:.1f} tokens/s"
+
@@ -0,0 +1,37 @@
+"""CPU副本池的核分配：副本不跨NUMA节点、按节点轮流分配、核数不足时不超额"""
+
+from cpu_pool import parse_cpu_list, plan_cpu_replicas
+
+NODES = [list(range(0, 8)), list(range(8, 16))]
+
+
+def test_parse_cpu_list():
+    assert parse_cpu_list("0-3,8-11\n") == [0, 1, 2, 3, 8, 9, 10, 11]
+    assert parse_cpu_list("5") == [5]
+    assert parse_cpu_list("") == []
+
+
+def test_auto_replicas_per_node():
+    plan = plan_cpu_replicas(0, 4, nodes=NODES)
+    assert plan == [(0, [0, 1, 2, 3]), (0, [4, 5, 6, 7]), (1, [8, 9, 10, 11]), (1, [12, 13, 14, 15])]
+
+
+def test_auto_gives_each_node_at_least_one_replica():
+    plan = plan_cpu_replicas(0, 16, nodes=NODES)
+    assert plan == [(0, NODES[0]), (1, NODES[1])]
+
+
+def test_fixed_replicas_round_robin_across_nodes():
+    plan = plan_cpu_replicas(3, 4, nodes=NODES)
+    assert [node for node, _ in plan] == [0, 0, 1]
+    assert plan[2] == (1, NODES[1])
+    # 同一节点内的副本平分该节点的核，不重叠
+    assert sorted(plan[0][1] + plan[1][1]) == NODES[0]
+
+
+def test_replicas_never_exceed_cores_or_cross_nodes():
+    nodes = [[0, 1], [2, 3]]
+    plan = plan_cpu_replicas(10, 1, nodes=nodes)
+    assert len(plan) == 4
+    for node, cpus in plan:
+        assert cpus and set(cpus) <= set(nodes[node])
@@ -0,0 +1,120 @@
+"""生成任务：采样参数解析、重复循环检测与停止词的增量输出保留"""
+
+import pytest
+
+from generation import DEFAULT_MAX_TOKENS, MAX_TOKENS_LIMIT, GenerationJob, RepetitionDetector, parse_sampling_params
+
+
+def test_sampling_params_defaults():
+    params = parse_sampling_params({})
+    assert params == {
+        "max_tokens": min(DEFAULT_MAX_TOKENS, MAX_TOKENS_LIMIT),
+        "temperature": 0.7,
+        "top_p": 0.9,
+        "top_k": 40,
+        "repeat_penalty": 1.1,
+        "stop": [],
+        "seed": None,
+    }
+
+
+def test_sampling_params_null_uses_defaults():
+    params = parse_sampling_params({"max_tokens": None, "temperature": None, "top_p": None, "top_k": None,
+                                    "repeat_penalty": None, "stop": None, "seed": None})
+    assert params == parse_sampling_params({})
+
+
+def test_sampling_params_keeps_greedy_and_converts_strings():
+    params = parse_sampling_params({"temperature": 0, "top_k": "5", "seed": "42", "stop": "###"})
+    assert params["temperature"] == 0.0
+    assert params["top_k"] == 5
+    assert params["seed"] == 42
+    assert params["stop"] == ["###"]
+
+
+def test_sampling_params_clamps_ranges():
+    params = parse_sampling_params({"max_tokens": MAX_TOKENS_LIMIT * 10, "temperature": -1, "top_p": 3, "top_k": -2})
+    assert params["max_tokens"] == MAX_TOKENS_LIMIT
+    assert params["temperature"] == 0.0
+    assert params["top_p"] == 1.0
+    assert params["top_k"] == 0
+
+
+@pytest.mark.parametrize("field, value", [
+    ("temperature", "hot"),
+    ("top_p", [0.5]),
+    ("top_k", "1.5"),
+    ("max_tokens", {"n": 1}),
+    ("seed", "abc"),
+    ("stop", 5),
+])
+def test_sampling_params_rejects_malformed_values(field, value):
+    with pytest.raises(ValueError, match=field):
+        parse_sampling_params({field: value})
+
+
+def test_repetition_detects_loop_after_min_repeats():
+    detector = RepetitionDetector(max_period=8, min_repeats=3, min_span=6)
+    loop = [1, 2, 3] * 3
+    results = [detector.feed(token) for token in loop]
+    assert results == [False] * 8 + [True]
+    assert detector.period == 3
+
+
+def test_repetition_respects_min_span():
+    detector = RepetitionDetector(max_period=8, min_repeats=3, min_span=6)
+    results = [detector.feed(7) for _ in range(6)]
+    assert results == [False] * 5 + [True]
+    assert detector.period == 1
+
+
+def test_repetition_ignores_varied_text_and_can_be_disabled():
+    detector = RepetitionDetector(max_period=8, min_repeats=3, min_span=6)
+    assert not any(detector.feed(token) for token in range(100))
+    disabled = RepetitionDetector(max_period=0, min_repeats=3, min_span=6)
+    assert not any(disabled.feed(1) for _ in range(100))
+
+
+def make_job(stop):
+    return GenerationJob([1], max_tokens=64, temperature=0, stop=stop)
+
+
+def test_stop_string_prefix_is_held_back_until_resolved():
+    job = make_job(["<|eot_id|>"])
+    assert job.append_token(10, b"Hello") is None
+    assert job.take_pieces() == ["Hello"]
+
+    # 末尾可能是停止词的开头，先不输出
+    assert job.append_token(11, b" <|eo") is None
+    assert job.take_pieces() == [" "]
+
+    assert job.append_token(12, b"t_id|>") == "stop"
+    assert job.text == "Hello "
+    job.finish("stop")
+    assert job.take_pieces() == []
+
+
+def test_held_prefix_is_released_when_it_is_not_a_stop_string():
+    job = make_job(["<|eot_id|>"])
+    job.append_token(10, b"a <|")
+    assert job.take_pieces() == ["a "]
+    job.append_token(11, b"xyz")
+    assert job.take_pieces() == ["<|xyz"]
+
+
+def test_stop_string_split_across_many_tokens():
+    job = make_job(["\n\n---"])
+    for token, piece in enumerate([b"Done.", b"\n", b"\n", b"-", b"-"]):
+        assert job.append_token(token, piece) is None
+    assert "".join(job.take_pieces()) == "Done."
+    assert job.append_token(5, b"-") == "stop"
+    assert job.text == "Done."
+
+
+def test_multibyte_characters_split_across_tokens():
+    job = make_job([])
+    encoded = "你好".encode()
+    job.append_token(1, encoded[:2])
+    job.append_token(2, encoded[2:])
+    assert job.text == "你好"
+    assert "".join(job.take_pieces()) == "你好"
@@ -0,0 +1,108 @@
+"""显存规划：GGUF头解析、各部分内存估算，以及在预算内选择卸载层数、上下文长度和KV精度"""
+
+import io
+
+import pytest
+
+from benchmark_handler import write_synthetic_gguf
+from memory_planner import estimate_memory, gguf_model_geometry, plan_model_memory, read_gguf_header
+
+GiB = 1024 ** 3
+
+
+@pytest.fixture(scope="module")
+def geometry():
+    f = io.BytesIO()
+    write_synthetic_gguf(f, n_vocab=2000)
+    f.seek(0)
+    return gguf_model_geometry(read_gguf_header(f))
+
+
+def test_header_round_trip(geometry):
+    assert geometry["arch"] == "llama"
+    assert geometry["n_layer"] == 24
+    assert geometry["n_head_kv"] == 8
+    assert geometry["key_length"] == geometry["value_length"] == 64
+    assert geometry["n_ctx_train"] == 32768
+    assert geometry["n_vocab"] == 2000
+    assert len(geometry["layer_bytes"]) == 24 and all(size > 0 for size in geometry["layer_bytes"])
+    assert geometry["input_bytes"] > 0 and geometry["output_bytes"] > 0
+
+
+def test_kv_cache_scales_with_context_and_type(geometry):
+    short = estimate_memory(geometry, 4096, -1)
+    long = estimate_memory(geometry, 8192, -1)
+    assert long["gpu_kv"] == 2 * short["gpu_kv"]
+    # 每层: n_ctx * n_head_kv * (key_length + value_length) * 2字节
+    assert short["gpu_kv"] == 24 * 4096 * 8 * 128 * 2
+    assert estimate_memory(geometry, 4096, -1, "q8_0")["gpu_kv"] < short["gpu_kv"]
+
+
+def test_batch_context_adds_kv_and_scratch(geometry):
+    alone = estimate_memory(geometry, 4096, -1)
+    batched = estimate_memory(geometry, 4096, -1, batch_ctx=4096)
+    assert batched["gpu_kv"] == 2 * alone["gpu_kv"]
+    assert batched["scratch"] > alone["scratch"]
+
+
+def test_logits_all_reserves_host_memory(geometry):
+    default = estimate_memory(geometry, 8192, -1)
+    logits_all = estimate_memory(geometry, 8192, -1, logits_all=True)
+    assert logits_all["cpu_bytes"] - default["cpu_bytes"] == (8192 - 512) * geometry["n_vocab"] * 4
+    assert logits_all["gpu_bytes"] == default["gpu_bytes"]
+
+
+def test_partial_and_no_offload(geometry):
+    full = estimate_memory(geometry, 4096, -1)
+    assert full["cpu_weights"] == geometry["input_bytes"]
+    assert full["cpu_kv"] == 0
+
+    # 从最后一层开始卸载，输出层只在全部卸载时才放到GPU
+    partial = estimate_memory(geometry, 4096, 12)
+    assert partial["gpu_weights"] == sum(geometry["layer_bytes"][12:])
+    assert partial["gpu_kv"] == partial["cpu_kv"]
+
+    cpu_only = estimate_memory(geometry, 4096, 0)
+    assert cpu_only["gpu_bytes"] == 0
+    assert cpu_only["cpu_kv"] == full["gpu_kv"]
+    assert cpu_only["cpu_weights"] == sum(geometry["layer_bytes"]) + geometry["input_bytes"] + geometry["output_bytes"]
+
+
+def test_plan_offloads_everything_with_large_budget(geometry):
+    plan = plan_model_memory(geometry, 80 * GiB, None, ["f16", "q8_0"])
+    assert plan["fits"]
+    assert plan["n_gpu_layers"] == -1
+    assert plan["n_ctx"] == 32768
+    assert plan["kv_type"] == "f16"
+
+
+def test_plan_trades_context_and_precision_before_layers(geometry):
+    full_min_ctx = estimate_memory(geometry, 4096, -1)["gpu_bytes"]
+    plan = plan_model_memory(geometry, full_min_ctx, None, ["f16", "q8_0"])
+    assert plan["fits"]
+    assert plan["n_gpu_layers"] == -1
+    assert plan["gpu_bytes"] <= full_min_ctx
+    assert plan["n_ctx"] >= 4096
+
+
+def test_plan_reduces_layers_when_weights_do_not_fit(geometry):
+    budget = estimate_memory(geometry, 4096, -1)["gpu_weights"] // 2
+    plan = plan_model_memory(geometry, budget, None)
+    assert plan["fits"]
+    assert 0 < plan["n_gpu_layers"] < geometry["n_layer"]
+    assert plan["gpu_bytes"] <= budget
+
+
+def test_plan_without_gpu_uses_host_memory(geometry):
+    plan = plan_model_memory(geometry, None, 64 * GiB)
+    assert plan["fits"]
+    assert plan["n_gpu_layers"] == 0
+    assert plan["gpu_bytes"] == 0
+
+
+def test_plan_reports_when_nothing_fits(geometry):
+    plan = plan_model_memory(geometry, 1, 1, ["f16", "q8_0"])
+    assert not plan["fits"]
+    assert plan["n_gpu_layers"] == 0
+    assert plan["n_ctx"] == 1024
+    assert plan["kv_type"] == "q8_0"
@@ -0,0 +1,71 @@
+"""长音频VAD切分：静音处分段、超长语音段再切、两端留余量且不重叠"""
+
+import numpy as np
+
+import stt
+
+RATE = stt.WHISPER_SAMPLE_RATE
+
+
+def tone(seconds, amplitude=0.5):
+    t = np.arange(int(seconds * RATE)) / RATE
+    return (amplitude * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+
+
+def silence(seconds, rng):
+    return (0.001 * rng.standard_normal(int(seconds * RATE))).astype(np.float32)
+
+
+def test_empty_and_short_audio():
+    assert stt.detect_speech_segments(np.zeros(0, dtype=np.float32)) == []
+    short = np.zeros(100, dtype=np.float32)
+    assert stt.detect_speech_segments(short) == [(0, 100)]
+
+
+def test_splits_on_silence():
+    rng = np.random.default_rng(0)
+    audio = np.concatenate([silence(1, rng), tone(1), silence(1, rng), tone(1.5), silence(1, rng)])
+    segments = stt.detect_speech_segments(audio)
+
+    assert len(segments) == 2
+    (first_start, first_end), (second_start, second_end) = segments
+    # 语音段覆盖原语音，余量不超过STT_VAD_PAD_MS
+    pad = stt.STT_VAD_PAD_MS / 1000 + stt.STT_VAD_FRAME_MS / 1000
+    assert 1.0 - pad <= first_start / RATE <= 1.0
+    assert 2.0 <= first_end / RATE <= 2.0 + pad
+    assert 3.0 - pad <= second_start / RATE <= 3.0
+    assert 4.5 <= second_end / RATE <= 4.5 + pad
+    assert first_end <= second_start
+
+
+def test_short_pauses_do_not_split():
+    rng = np.random.default_rng(1)
+    pause = stt.STT_VAD_MIN_SILENCE_MS / 1000 / 2
+    audio = np.concatenate([tone(1), silence(pause, rng), tone(1)])
+    assert len(stt.detect_speech_segments(audio)) == 1
+
+
+def test_long_speech_is_cut_below_max_segment():
+    audio = tone(70)
+    segments = stt.detect_speech_segments(audio)
+
+    limit = stt.STT_VAD_MAX_SEGMENT_SECONDS + 2 * stt.STT_VAD_PAD_MS / 1000
+    assert len(segments) >= 3
+    assert all((end - start) / RATE <= limit for start, end in segments)
+    # 连续语音切分后首尾相接，覆盖整段音频
+    assert segments[0][0] == 0
+    assert segments[-1][1] >= len(audio) - RATE * stt.STT_VAD_FRAME_MS // 1000
+    for (_, end), (start, _) in zip(segments, segments[1:]):
+        assert end <= start
+
+
+def test_join_segment_texts_and_language():
+    segments = [
+        {"text": "你好", "language": "zh"},
+        {"text": "", "language": "en"},
+        {"text": "世界", "language": "zh"},
+    ]
+    language = stt.most_common_language(segments)
+    assert language == "zh"
+    assert stt.join_segment_texts(segments, language) == "你好世界"
+    assert stt.join_segment_texts([{"text": "hello"}, {"text": "world"}], "en") == "hello world"